@@ -0,0 +1,412 @@
+""" Micro-benchmarks of the service hot paths.
+Run a benchmark:
+    python mn_bench.py --bench=find --requests=2000
+"""
+__author__ = 'morozov'
+import os
+import shutil
+import tempfile
+import time
+import socket
+import tornado.httpclient
+import tornado.httputil
+import tornado.iostream
+import tornado.netutil
+from tornado.ioloop import IOLoop
+from tornado.options import define, options
+import mn_httpserver as http
+import mn_instance as instance
+import mn_directory
+from mynotes import MN_PRODUCT_ID, MN_REQUEST_ID
+
+define('bench', default='find', type=str)
+define('requests', default=1000, type=int)
+
+
+def _percentile(values, fraction):
+    _values = sorted(values)
+    return _values[min(len(_values)-1, int(len(_values)*fraction))]
+
+
+def _report(name, times):
+    #   times - list of seconds
+    print('%-12s n=%-6i avg=%.1fus p50=%.1fus p99=%.1fus' % (
+        name, len(times),
+        sum(times)/len(times)*1e6, _percentile(times, 0.5)*1e6, _percentile(times, 0.99)*1e6))
+
+
+class _BenchEnv:
+    #   Temporary directory with range files and unix socket for a bench instance
+    def __init__(self, port):
+        self.path = tempfile.mkdtemp(prefix='mn_bench')
+        self.port = str(port)
+        _master_range = os.path.join(self.path, 'master.ini')
+        with open(_master_range, 'w') as fd:
+            fd.write('1000000\n80000000')
+        with open(os.path.join(self.path, 'range.ini'), 'w') as fd:
+            fd.write('1\n999999')
+        options.unix_socket = os.path.join(self.path, '%s.sock')
+        self.instance = instance.mn_instance(
+            instance.MN_LOCALHOST, self.port,
+            master_instance=(instance.MN_LOCALHOST, self.port),
+            range_file=os.path.join(self.path, 'range.ini'),
+            range_size=1000,
+            master_range=_master_range)
+
+    def application(self, handlers):
+        return http.Application_mn(handlers, instance=self.instance)
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def _fetch_serial(url, headers, num, resolver=None):
+    #   Fetches url num times one by one, returns the list of latencies
+    io_loop = IOLoop.instance()
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True, resolver=resolver)
+    times = []
+
+    def _next(response=None):
+        if response is not None:
+            assert not response.error, response.error
+            times.append(time.time() - _next.started)
+        if len(times) == num:
+            io_loop.stop()
+            return
+        _next.started = time.time()
+        request = tornado.httpclient.HTTPRequest(url, body='', method='POST', use_gzip=False, headers=headers)
+        client.fetch(request, _next)
+
+    io_loop.add_callback(_next)
+    io_loop.start()
+    client.close()
+    return times
+
+
+def bench_snapshot():
+    #   Directory of --requests locations: snapshot pulled by another instance through the unix socket
+    _sock = tornado.netutil.bind_sockets(0, '127.0.0.1', family=socket.AF_INET)[0]
+    _port = str(_sock.getsockname()[1])
+    _sock.close()
+    env = _BenchEnv(_port)
+    tornado.httpclient.AsyncHTTPClient.configure(
+        None, resolver=instance.UnixResolver(resolver=tornado.netutil.Resolver()))
+    try:
+        for _i in xrange(options.requests):
+            env.instance._updateLocation(str(10000000 + _i), (instance.MN_LOCALHOST, str(8081 + _i % 4)))
+        server = http.HTTPServer_mn(env.application([(r"/snapshot.*", instance.inst_Snapshot)]))
+        server.add_socket(tornado.netutil.bind_unix_socket(instance.unix_socket_path(_port)))
+
+        with open(os.path.join(env.path, 'range2.ini'), 'w') as fd:
+            fd.write('1\n999')
+        _joined = instance.mn_instance(
+            instance.MN_LOCALHOST, '1',
+            master_instance=(instance.MN_LOCALHOST, _port),
+            range_file=os.path.join(env.path, 'range2.ini'),
+            range_size=1000)
+        _joined._instances.append(_port)
+        io_loop = IOLoop.instance()
+        _started = time.time()
+        io_loop.add_callback(instance.SnapshotLoader(_joined, callback=io_loop.stop).start)
+        io_loop.start()
+        _time = time.time() - _started
+        print('snapshot     n=%-6i %.2fs %i locations/s' % (len(_joined._IDs), _time, len(_joined._IDs)/_time))
+        server.stop()
+    finally:
+        env.close()
+
+
+def bench_restart():
+    #   Instance start with the directory log of --requests locations, then its compaction
+    env = _BenchEnv(1)
+    try:
+        options.directory_log = os.path.join(env.path, 'directory.log')
+        _log = mn_directory.DirectoryLog(options.directory_log)
+        _log.open()
+        for _i in xrange(options.requests):
+            _log.location(str(10000000 + _i), (instance.MN_LOCALHOST, str(8081 + _i % 4)))
+        _log.close()
+
+        _started = time.time()
+        _restarted = instance.mn_instance(
+            instance.MN_LOCALHOST, env.port,
+            master_instance=(instance.MN_LOCALHOST, env.port),
+            range_file=os.path.join(env.path, 'range.ini'),
+            range_size=1000,
+            master_range=os.path.join(env.path, 'master.ini'))
+        _time = time.time() - _started
+        print('restart      n=%-6i %.2fs %i locations/s' % (len(_restarted._IDs), _time, len(_restarted._IDs)/_time))
+
+        _started = time.time()
+        _restarted.close()
+        print('compaction   n=%-6i %.2fs' % (len(_restarted._IDs), time.time() - _started))
+    finally:
+        env.close()
+
+
+def bench_register():
+    #   /getuniversalid latency, range file writes (compare --range_reserve=1)
+    _sock = tornado.netutil.bind_sockets(0, '127.0.0.1', family=socket.AF_INET)[0]
+    _port = str(_sock.getsockname()[1])
+    env = _BenchEnv(_port)
+    try:
+        server = http.HTTPServer_mn(env.application([(r"/getuniversalid", instance.agent_getID)]))
+        server.add_socket(_sock)
+        url = 'http://127.0.0.1:%s/getuniversalid' % _port
+        _writes = env.instance._range.writes
+        _report('register', _fetch_serial(url, {}, options.requests))
+        print('range writes %i' % (env.instance._range.writes - _writes))
+        server.stop()
+    finally:
+        env.close()
+
+
+def bench_find():
+    #   /find latency: TCP loopback vs unix domain socket
+    _sock = tornado.netutil.bind_sockets(0, '127.0.0.1', family=socket.AF_INET)[0]
+    _port = str(_sock.getsockname()[1])
+    env = _BenchEnv(_port)
+    try:
+        env.instance._updateLocation('26018363')
+        server = http.HTTPServer_mn(env.application([(r"/find.*", instance.inst_Find)]))
+        server.add_socket(_sock)
+        server.add_socket(tornado.netutil.bind_unix_socket(instance.unix_socket_path(_port)))
+
+        url, headers = env.instance._url_localhost('find', port=_port)
+        headers[MN_PRODUCT_ID] = '26018363'
+        _fetch_serial(url, headers, 100)    # warm up
+        _report('find/tcp', _fetch_serial(url, headers, options.requests))
+        _resolver = instance.UnixResolver(resolver=tornado.netutil.Resolver())
+        _report('find/unix', _fetch_serial(url, headers, options.requests, resolver=_resolver))
+        server.stop()
+    finally:
+        env.close()
+
+
+# header blocks of the requests as they come from nginx
+HEADER_SETS = {
+    'agent': 'POST /agent/8081 HTTP/1.0\r\n'
+             'Host: mynotes.your_domain.com\r\n'
+             'X-Real-IP: 93.184.216.34\r\n'
+             'X-Forwarded-For: 93.184.216.34\r\n'
+             'Connection: close\r\n'
+             'Content-Length: 0\r\n'
+             'X-IWP-ProductUnivId: 26018363\r\n'
+             'X-IWP-IsRecycle: 0\r\n'
+             'User-Agent: MyNotes Desktop/2.4.1 (Windows NT 6.1)\r\n'
+             'Accept-Encoding: identity\r\n\r\n',
+    'agentreply': 'POST /agentreply/8081 HTTP/1.0\r\n'
+                  'Host: mynotes.your_domain.com\r\n'
+                  'X-Real-IP: 93.184.216.34\r\n'
+                  'X-Forwarded-For: 93.184.216.34\r\n'
+                  'Connection: close\r\n'
+                  'Content-Length: 5214\r\n'
+                  'Content-Type: application/octet-stream\r\n'
+                  'X-IWP-ProductUnivId: 26018363\r\n'
+                  'X-IWP-RequestId: 184467\r\n'
+                  'X-iwp-responsecode: 200\r\n'
+                  'User-Agent: MyNotes Desktop/2.4.1 (Windows NT 6.1)\r\n'
+                  'Accept-Encoding: identity\r\n\r\n',
+    'client': 'POST /client/8081 HTTP/1.0\r\n'
+              'Host: mynotes.your_domain.com\r\n'
+              'X-Real-IP: 172.58.12.201\r\n'
+              'X-Forwarded-For: 172.58.12.201\r\n'
+              'Connection: close\r\n'
+              'Content-Length: 312\r\n'
+              'Content-Type: application/x-www-form-urlencoded\r\n'
+              'X-IWP-ProductUnivId: 26018363\r\n'
+              'Accept: */*\r\n'
+              'Accept-Language: en-us\r\n'
+              'Accept-Encoding: gzip, deflate\r\n'
+              'Cookie: _ga=GA1.2.1543243221.1391172839; session=2f6b0e6e\r\n'
+              'User-Agent: MyNotes/3.1 CFNetwork/672.0.8 Darwin/14.0.0\r\n\r\n',
+    'instance': 'POST /connected/8082 HTTP/1.1\r\n'
+                'Host: localhost:8082\r\n'
+                'Content-Length: 0\r\n'
+                'Connection: close\r\n'
+                'X-IWP-ProductUnivId: 26018363\r\n'
+                'X-IWP-Host: mynotes.your_domain.com\r\n'
+                'X-IWP-Port: 8081\r\n'
+                'X-IWP-Target-Port: 8082\r\n'
+                'Accept-Encoding: gzip\r\n\r\n',
+}
+# headers read for every request: HTTPRequest, HTTPConnection, handlers and the access log
+HEADERS_READ = ['Host', 'Content-Length', 'Expect', MN_PRODUCT_ID, 'X-IWP-RequestId', 'X-IWP-Host', 'X-IWP-Port',
+                'X-iwp-responsecode', 'X-Real-IP', 'X-Forwarded-For', 'Connection']
+
+
+def bench_headers():
+    #   Header block parsing as HTTPConnection_mn does it: HTTPHeaders.parse vs LazyHTTPHeaders
+    def _parse_full(data):
+        data = data.decode('latin1').encode('utf-8')
+        eol = data.find('\r\n')
+        data[:eol].split(' ')
+        return tornado.httputil.HTTPHeaders.parse(data[eol:])
+
+    def _parse_lazy(data):
+        eol = data.find('\r\n')
+        data[:eol].split(' ')
+        return http.LazyHTTPHeaders(data[eol:])
+
+    for _name in sorted(HEADER_SETS):
+        _data = HEADER_SETS[_name]
+        for _parser, _parse in (('full', _parse_full), ('lazy', _parse_lazy)):
+            times = []
+            for _i in range(options.requests):
+                _started = time.time()
+                _headers = _parse(_data)
+                for _header in HEADERS_READ:
+                    _headers.get(_header)
+                times.append(time.time() - _started)
+            _report('%s/%s' % (_name, _parser), times)
+
+
+class _EpollCounter:
+    #   epoll object of the IOLoop counting epoll_ctl calls
+    def __init__(self, impl):
+        self._impl = impl
+        self.calls = 0
+
+    def register(self, fd, events):
+        self.calls += 1
+        return self._impl.register(fd, events)
+
+    def modify(self, fd, events):
+        self.calls += 1
+        return self._impl.modify(fd, events)
+
+    def unregister(self, fd):
+        self.calls += 1
+        return self._impl.unregister(fd)
+
+    def __getattr__(self, name):
+        return getattr(self._impl, name)
+
+
+def bench_relay():
+    #   Interaction relay of --requests MB (4K chunks): tornado IOStream read_bytes vs IOStream_mn read_view
+    _size = options.requests * 1024 * 1024
+    _payload = os.urandom(65536)
+    io_loop = IOLoop.instance()
+    io_loop._impl = _epoll = _EpollCounter(io_loop._impl)
+
+    def _relay(name, stream_class, read):
+        _src_w, _src_r = socket.socketpair()
+        _dst_w, _dst_r = socket.socketpair()
+        source = tornado.iostream.IOStream(_src_w)
+        if stream_class is http.IOStream_mn:
+            # as Interaction reads the request of the service
+            relay_in = stream_class(_src_r, max_buffer_size=options.stream_buffer_max)
+            relay_in.borrow(_size)
+        else:
+            relay_in = stream_class(_src_r)
+        relay_out = stream_class(_dst_w)
+        sink = tornado.iostream.IOStream(_dst_r)
+        _state = {'remaining': _size, 'sent': 0}
+
+        def _send():
+            # the sender keeps up to 2 payloads ahead of the relay (tornado IOStream would read it all)
+            while _state['sent'] < _size and _state['sent'] - (_size - _state['remaining']) < 2 * len(_payload):
+                _state['sent'] += len(_payload)
+                source.write(_payload)
+
+        def _read_chunk():
+            getattr(relay_in, read)(min(4096, _state['remaining']), _data)
+
+        def _data(data):
+            _state['remaining'] -= len(data)
+            _send()
+            relay_out.write(data, _read_chunk if _state['remaining'] else None)
+
+        sink.read_bytes(_size, lambda data: io_loop.stop(), streaming_callback=lambda data: None)
+        _copies, _views, _calls = http.IOStream_mn.copies, http.IOStream_mn.views, _epoll.calls
+        _started = time.time()
+        _send()
+        _read_chunk()
+        io_loop.start()
+        _time = time.time() - _started
+        # tornado IOStream: str per recv, merge per chunk (not counted)
+        print('%-12s %iMB %.2fs %.0fMB/s copies/MB=%i views/MB=%i epoll_ctl/MB=%.1f' % (
+            name, options.requests, _time, options.requests/_time,
+            (http.IOStream_mn.copies - _copies)/options.requests,
+            (http.IOStream_mn.views - _views)/options.requests,
+            (_epoll.calls - _calls)/float(options.requests)))
+        for _stream in (source, relay_in, relay_out, sink):
+            _stream.close()
+
+    _relay('relay/tornado', tornado.iostream.IOStream, 'read_bytes')
+    _relay('relay/bytes', http.IOStream_mn, 'read_bytes')
+    _relay('relay/view', http.IOStream_mn, 'read_view')
+
+
+def bench_interaction():
+    #   send() syscalls of the service per App/Desktop interaction: chunk by chunk vs gathered
+    import mn_service
+    _sock = tornado.netutil.bind_sockets(0, '127.0.0.1', family=socket.AF_INET)[0]
+    _port = str(_sock.getsockname()[1])
+    env = _BenchEnv(_port)
+    try:
+        env.instance.ready = True
+        server = http.HTTPServer_mn(env.application([
+            (r"/client/.*", mn_service.Client),
+            (r"/agentreply/.*", mn_service.Agent_reply),
+            (r"/agent/.*", mn_service.Agent_ready)]))
+        server.add_socket(_sock)
+        io_loop = IOLoop.instance()
+        client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        _url = 'http://127.0.0.1:%s/%%s/%s' % (_port, _port)
+
+        def _post(path, headers, body, callback):
+            client.fetch(tornado.httpclient.HTTPRequest(_url % path, method='POST', body=body, headers=headers,
+                                                        use_gzip=False), callback)
+
+        def _interactions(size, num):
+            _state = {'left': num}
+
+            def _next():
+                if not _state['left']:
+                    io_loop.stop()
+                    return
+                _state['left'] -= 1
+                _post('agent', {MN_PRODUCT_ID: '26018363'}, '', _agent_request)
+                io_loop.add_timeout(time.time() + 0.001,
+                                    lambda: _post('client', {MN_PRODUCT_ID: '26018363'}, 'a' * size, _replied))
+
+            def _agent_request(response):
+                assert not response.error, response.error
+                _post('agentreply', {MN_PRODUCT_ID: '26018363', MN_REQUEST_ID: response.headers[MN_REQUEST_ID]},
+                      response.body, lambda response: None)
+
+            def _replied(response):
+                assert not response.error, response.error
+                _next()
+
+            _next()
+            io_loop.start()
+
+        for _size in (100, 3000, 40000):
+            for _name, _gather in (('chunks', 0), ('gathered', http.WRITE_GATHER_SIZE)):
+                http.WRITE_GATHER_SIZE = _gather
+                _sends = http.IOStream_mn.sends
+                _interactions(_size, options.requests)
+                print('%-8s %-6i sends/interaction=%.1f' % (
+                    _name, _size, (http.IOStream_mn.sends - _sends) / float(options.requests)))
+        client.close()
+        server.stop()
+    finally:
+        env.close()
+
+
+BENCHMARKS = {
+    'headers': bench_headers,
+    'interaction': bench_interaction,
+    'relay': bench_relay,
+    'find': bench_find,
+    'snapshot': bench_snapshot,
+    'restart': bench_restart,
+    'register': bench_register,
+}
+
+if __name__ == "__main__":
+    tornado.options.parse_command_line()
+    BENCHMARKS[options.bench]()
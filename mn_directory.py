@@ -0,0 +1,657 @@
+""" Desktop location directory (ProductID -> (server, port)):
+- LocationDirectory: instance directory limited in size, locations expire unless refreshed
+- SharedDirectory: hash table in a memory-mapped file shared by all instances of the server
+- MissCache: ProductIDs recently not found
+- BloomFilter: compact digest of the ProductIDs connected to an instance
+- DirectoryLog: append-only file of the instance directory to restart with
+"""
+__author__ = 'morozov'
+import os
+import sys
+import mmap
+import fcntl
+import struct
+from time import time
+from collections import deque
+from itertools import islice
+from zlib import crc32
+from hashlib import md5
+from tornado.ioloop import IOLoop
+from tornado.log import gen_log
+from tornado.options import define, options
+from mn_stats import stats_mon
+from mn_range import fsync_directory
+
+# instance directory: max locations kept, seconds location is kept unless refreshed by Desktop activity
+define('directory_max_entries', default=1000000, type=int)
+define('directory_ttl', default=86400, type=int)
+
+# shared directory file, e.g. 'run/directory.shm' (None - every instance keeps its own directory)
+define('shm_directory', default=None, type=str)
+# shared directory slots, 24 bytes each: 2**21 slots = 48Mb, enough for 1.5M customers
+define('shm_directory_size', default=2**21, type=int)
+
+# append-only log of the instance directory (per instance file), loaded at start
+define('directory_log', default=None, type=str)
+
+# digest of the instance Desktops: bits of Bloom filter
+define('digest_bits', default=2**20, type=int)
+
+SHM_MAGIC = 'MNDIR001'
+SHM_HEADER = struct.Struct('<8sII')         # magic, slots, servers
+SHM_SERVER = struct.Struct('<64s')          # server name, index is the position in table + 1
+SHM_SERVERS_MAX = 254
+SHM_SERVERS_OFFSET = 64
+SHM_SLOTS_OFFSET = 16384                    # header + server table
+SHM_SLOT = struct.Struct('<IQHHI4x')        # seq, key, port, server index, stamp
+SHM_SEQ = struct.Struct('<I')
+SHM_ENTRY = struct.Struct('<QHHI')
+SHM_PROBE = 16                              # slots probed for a key
+SHM_READ_RETRIES = 8
+
+DIR_GENERATIONS = 8                         # TTL slices, location expires with its slice
+DIR_LOCATIONS_MAX = 1 << 16                 # interned locations
+DIR_SAMPLE = 100                            # keys to estimate key size
+
+DIR_LOG_COMPACT = 2                         # compact the log when records > entries * DIR_LOG_COMPACT + DIR_LOG_MIN
+DIR_LOG_MIN = 100000
+DIR_LOG_BATCH = 10000                       # records written by compaction at a time
+
+BLOOM_HASHES = 7                            # bits per ProductID, ~1% false positives at 10 bits per ProductID
+
+
+def directory_key(ProductID):
+    #   Integer key of numeric ProductID (the same string back from str()), ProductID itself otherwise
+    if ProductID and ProductID.isdigit() and ProductID[0] != '0':
+        return int(ProductID)
+    return ProductID
+
+
+class LocationDirectory:
+    #   ProductID -> (server, port):
+    #   - locations are interned, value is an int: generation * DIR_LOCATIONS_MAX + location index;
+    #   - TTL is split to DIR_GENERATIONS slices (generations), every generation is a set of keys
+    #     set or refreshed within its slice; the oldest generation expires as a whole;
+    #   - if there are more than max_entries locations, the keys of the oldest generation are evicted first.
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._slice = max(float(ttl) / DIR_GENERATIONS, 1)
+        self._locations = []            # index -> (server, port)
+        self._location_index = {}       # (server, port) -> index
+        self._entries = {}              # key -> generation * DIR_LOCATIONS_MAX + location index
+        self._generations = deque()     # [(number, started, set of keys)], the oldest first
+        self._generation = 0
+        self._stale_generation = None  # locations loaded from the log, not confirmed yet
+        self.evicted = self.expired = 0
+        self._rotate()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, ProductID):
+        return self.get(ProductID) is not None
+
+    def get(self, ProductID):
+        self._rotate()
+        _value = self._entries.get(directory_key(ProductID))
+        if _value is None:
+            return None
+        return self._locations[_value % DIR_LOCATIONS_MAX]
+
+    def set(self, ProductID, location):
+        self._rotate()
+        _key = directory_key(ProductID)
+        self._refresh(_key, self._intern(location))
+        if len(self._entries) > self.max_entries:
+            self._evict(len(self._entries) - self.max_entries)
+
+    def touch(self, ProductID):
+        #   Refreshes TTL of the location,
+        #   returns True if the location moved to the new generation (i.e. once per TTL slice)
+        self._rotate()
+        _key = directory_key(ProductID)
+        _value = self._entries.get(_key)
+        if _value is None or _value // DIR_LOCATIONS_MAX == self._generation:
+            return False
+        self._refresh(_key, _value % DIR_LOCATIONS_MAX)
+        return True
+
+    def load(self, ProductID, location):
+        #   Sets stale location: it's kept until confirmed by set()/touch() or expired as usual
+        if self._stale_generation is None:
+            _now = time()
+            self._generation += 1
+            self._stale_generation = self._generation
+            self._generations.append((self._generation, _now, set()))
+            self._generation += 1
+            self._generations.append((self._generation, _now, set()))
+        _key = directory_key(ProductID)
+        _index = self._intern(location)
+        _value = self._entries.get(_key)
+        if _value is not None:
+            self._generation_keys(_value // DIR_LOCATIONS_MAX).discard(_key)
+        self._generation_keys(self._stale_generation).add(_key)
+        self._entries[_key] = self._stale_generation * DIR_LOCATIONS_MAX + _index
+
+    def stale(self, ProductID):
+        _value = self._entries.get(directory_key(ProductID))
+        return _value is not None and _value // DIR_LOCATIONS_MAX == self._stale_generation
+
+    def remove(self, ProductID):
+        _key = directory_key(ProductID)
+        _value = self._entries.pop(_key, None)
+        if _value is not None:
+            self._generation_keys(_value // DIR_LOCATIONS_MAX).discard(_key)
+
+    def items(self):
+        #   (ProductID, location) of the keys at the moment, removed later ones are skipped;
+        #   the directory may be changed meanwhile
+        for _key in self._entries.keys():
+            _value = self._entries.get(_key)
+            if _value is not None:
+                yield str(_key), self._locations[_value % DIR_LOCATIONS_MAX]
+
+    def located(self, location):
+        #   ProductIDs of the location (scans the whole directory)
+        _index = self._location_index.get(location)
+        if _index is None:
+            return []
+        return [str(_key) for _key, _value in self._entries.iteritems() if _value % DIR_LOCATIONS_MAX == _index]
+
+    def memory(self):
+        #   Estimated bytes used by the entries
+        _size = sys.getsizeof(self._entries)
+        for _generation in self._generations:
+            _size += sys.getsizeof(_generation[2])
+        _sample = list(islice(self._entries.iteritems(), DIR_SAMPLE))
+        if _sample:
+            _size += len(self._entries) * \
+                     sum(sys.getsizeof(_key) + sys.getsizeof(_value) for _key, _value in _sample) / len(_sample)
+        return _size
+
+    def _refresh(self, key, index):
+        _value = self._entries.get(key)
+        if _value is not None and _value // DIR_LOCATIONS_MAX != self._generation:
+            self._generation_keys(_value // DIR_LOCATIONS_MAX).discard(key)
+        self._generations[-1][2].add(key)
+        self._entries[key] = self._generation * DIR_LOCATIONS_MAX + index
+
+    def _intern(self, location):
+        _index = self._location_index.get(location)
+        if _index is None:
+            if len(self._locations) >= DIR_LOCATIONS_MAX:
+                raise EnvironmentError, "More than %i instances in the directory" % DIR_LOCATIONS_MAX
+            _index = len(self._locations)
+            self._locations.append(location)
+            self._location_index[location] = _index
+        return _index
+
+    def _generation_keys(self, number):
+        _first = self._generations[0][0]
+        if number < _first:
+            return set()
+        return self._generations[number - _first][2]
+
+    def _rotate(self):
+        #   Starts the new generation if the slice is over, drops the expired ones
+        _now = time()
+        if self._generations and _now - self._generations[-1][1] < self._slice:
+            return
+        self._generation += 1
+        self._generations.append((self._generation, _now, set()))
+        while _now - self._generations[0][1] > self.ttl + self._slice:
+            _number, _started, _keys = self._generations.popleft()
+            for _key in _keys:
+                del self._entries[_key]
+            self.expired += len(_keys)
+            if options.stats_enabled:
+                stats_mon._count('Directory_Expired', len(_keys))
+
+    def _evict(self, num):
+        _evicted = 0
+        for _number, _started, _keys in self._generations:
+            while _keys and _evicted < num:
+                del self._entries[_keys.pop()]
+                _evicted += 1
+            if _evicted == num:
+                break
+        self.evicted += _evicted
+        if options.stats_enabled:
+            stats_mon._count('Directory_Evicted', _evicted)
+
+
+class MissCache:
+    #   ProductIDs not found by the last search, kept for ttl seconds (or until the location is known)
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._expires = {}          # ProductID -> expiration time
+        self._order = deque()       # (expiration time, ProductID), the oldest first
+
+    def __len__(self):
+        return len(self._expires)
+
+    def __contains__(self, ProductID):
+        _expires = self._expires.get(ProductID)
+        return _expires is not None and _expires > time()
+
+    def add(self, ProductID):
+        _now = time()
+        self._purge(_now)
+        self._expires[ProductID] = _now + self.ttl
+        self._order.append((_now + self.ttl, ProductID))
+
+    def discard(self, ProductID):
+        self._expires.pop(ProductID, None)
+
+    def _purge(self, now):
+        while self._order and self._order[0][0] <= now:
+            _expires, _ProductID = self._order.popleft()
+            if self._expires.get(_ProductID) == _expires:
+                del self._expires[_ProductID]
+
+
+class BloomFilter:
+    #   Set of ProductIDs without false negatives:
+    #   'ID in filter' is False if ID was never added, may be True for other IDs (false positive)
+    def __init__(self, bits=None, data=None):
+        if data is not None:
+            self._bits = bytearray(data)
+        else:
+            self._bits = bytearray((bits + 7) // 8)
+        self.size = len(self._bits) * 8
+
+    def __contains__(self, ProductID):
+        _bits = self._bits
+        for _bit in self._positions(ProductID):
+            if not _bits[_bit >> 3] & (1 << (_bit & 7)):
+                return False
+        return True
+
+    def add(self, ProductID):
+        _bits = self._bits
+        for _bit in self._positions(ProductID):
+            _bits[_bit >> 3] |= 1 << (_bit & 7)
+
+    def update(self, ProductIDs):
+        for _ProductID in ProductIDs:
+            self.add(_ProductID)
+
+    def tostring(self):
+        return str(self._bits)
+
+    def _positions(self, ProductID):
+        #   double hashing: h1 + i*h2
+        _hash = int(md5(ProductID).hexdigest(), 16)
+        _h1, _h2 = _hash >> 64, (_hash & 0xFFFFFFFFFFFFFFFF) | 1
+        return [(_h1 + _i*_h2) % self.size for _i in xrange(BLOOM_HASHES)]
+
+
+class DirectoryLog:
+    #   Append-only log of the instance directory: 'L ProductID server port' (location)
+    #   and 'P ProductID' (Desktop present at the instance) lines, the last location of ProductID wins.
+    #   Records are buffered and appended by flush(). Compaction writes the directory to a temporary file
+    #   batch by batch, then the records appended meanwhile, and renames it over the log.
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+        self._buffer = []
+        self._records = 0
+        self._compacting = None         # data appended since the compaction started
+        self._compaction = None
+
+    def load(self):
+        #   Yields (ProductID, location) of the log, location is None for 'P' records
+        self._records = 0
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as fd:
+            for _line in fd:
+                if not _line.endswith('\n'):
+                    # not finished by the crash
+                    break
+                self._records += 1
+                _fields = _line[:-1].split(' ')
+                if _fields[0] == 'L' and len(_fields) == 4:
+                    yield _fields[1], (_fields[2], _fields[3])
+                elif _fields[0] == 'P' and len(_fields) == 2:
+                    yield _fields[1], None
+
+    def open(self):
+        self._fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def close(self):
+        self.flush()
+        os.close(self._fd)
+        self._fd = None
+
+    def location(self, ProductID, location):
+        self._buffer.append('L %s %s %s\n' % (ProductID, location[0], location[1]))
+
+    def flush(self):
+        if not self._buffer:
+            return
+        _data = ''.join(self._buffer)
+        self._records += len(self._buffer)
+        self._buffer = []
+        os.write(self._fd, _data)
+        if self._compacting is not None:
+            self._compacting.append(_data)
+
+    def need_compaction(self, entries):
+        return self._compacting is None and self._records > entries * DIR_LOG_COMPACT + DIR_LOG_MIN
+
+    def compact(self, items, present, sync=False):
+        #   Rewrites the log: items - (ProductID, location) iterator, present - ProductIDs;
+        #   asynchronous (batch per IOLoop iteration) unless sync;
+        #   the running compaction is cancelled (its temporary file is the same)
+        self.flush()
+        if self._compaction is not None:
+            self._compaction.cancel()
+        self._compacting = []
+        self._compaction = _compaction = _LogCompaction(self, items, present)
+        if sync:
+            while _compaction.write_batch():
+                pass
+        else:
+            _compaction.start()
+
+    def _compacted(self, temp, records):
+        self.flush()
+        with open(temp, 'ab') as fd:
+            fd.write(''.join(self._compacting))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(temp, self.filename)
+        fsync_directory(self.filename)
+        os.close(self._fd)
+        self.open()
+        self._records = records + sum(_data.count('\n') for _data in self._compacting)
+        self._compacting = None
+        self._compaction = None
+
+
+class _LogCompaction:
+    def __init__(self, log, items, present):
+        self._log = log
+        self._items = items
+        self._present = present
+        self._temp = log.filename + '.tmp'
+        self._fd = open(self._temp, 'wb')
+        self._records = 0
+
+    def start(self):
+        if self._fd is not None and self.write_batch():
+            IOLoop.instance().add_callback(self.start)
+
+    def cancel(self):
+        #   Stops the compaction, the temporary file is removed
+        self._fd.close()
+        self._fd = None
+        os.remove(self._temp)
+
+    def write_batch(self):
+        #   Returns False when the compaction is done
+        _lines = ['L %s %s %s\n' % (_ProductID, _location[0], _location[1])
+                  for _ProductID, _location in islice(self._items, DIR_LOG_BATCH)]
+        if _lines:
+            self._fd.write(''.join(_lines))
+            self._records += len(_lines)
+            return True
+        self._fd.write(''.join('P %s\n' % _ProductID for _ProductID in self._present))
+        self._records += len(self._present)
+        self._fd.close()
+        self._log._compacted(self._temp, self._records)
+        return False
+
+
+class SharedDirectory:
+    #   Open addressing hash table in a memory-mapped file:
+    #   - readers don't lock, slot sequence number (odd while being written) detects torn reads;
+    #   - writer locks the key (fcntl byte-range lock beyond the table) and then the slot it writes,
+    #     so there is a single writer per slot across all the processes;
+    #   - odd sequence number of the slot found by the writer under the slot lock is left by the crashed writer:
+    #     it's made even again (the entry is the first to be replaced);
+    #   - table is never resized: the oldest entry of the probe sequence is replaced if there is no room.
+    #   Only numeric ProductIDs are kept, the others return None from key().
+    #   Server names longer than SHM_SERVER field are rejected (ValueError), see fits();
+    #   the location of ProductID kept elsewhere is discarded: the slot keeps the key with server index 0.
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = int(size)
+        self._length = SHM_SLOTS_OFFSET + self.size * SHM_SLOT.size
+        self._servers = {}          # server -> index
+        self._names = {}            # index -> server
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock(0)
+        try:
+            if os.fstat(self._fd).st_size < self._length:
+                os.ftruncate(self._fd, self._length)
+            self._mm = mmap.mmap(self._fd, self._length)
+            _magic, _size, _count = SHM_HEADER.unpack_from(self._mm, 0)
+            if _magic != SHM_MAGIC:
+                SHM_HEADER.pack_into(self._mm, 0, SHM_MAGIC, self.size, 0)
+            elif _size != self.size:
+                raise EnvironmentError, "File '%s' has %i slots, %i expected" % (filename, _size, self.size)
+        finally:
+            self._unlock(0)
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+    @staticmethod
+    def fits(server):
+        #   The server name can be kept in the table
+        return len(server) <= SHM_SERVER.size
+
+    @staticmethod
+    def key(ProductID):
+        #   Integer key of ProductID, None if it can't be kept in the table
+        if ProductID and ProductID.isdigit() and ProductID[0] != '0':
+            _key = int(ProductID)
+            if _key < 2**64:
+                return _key
+        return None
+
+    def get(self, ProductID):
+        #   (server, port) or None
+        _key = self.key(ProductID)
+        if _key is None:
+            return None
+        for _slot in self._probe(_key):
+            _entry = self._read(_slot)
+            if _entry is None:
+                continue
+            if not _entry[0]:
+                return None
+            if _entry[0] == _key:
+                if not _entry[2]:
+                    return None
+                return self._server_name(_entry[2]), str(_entry[1])
+        return None
+
+    def set(self, ProductID, location):
+        #   Stores (server, port), returns False if ProductID can't be kept in the table
+        _key = self.key(ProductID)
+        if _key is None:
+            return False
+        _server = self._server_index(location[0])
+        _home = SHM_SLOTS_OFFSET + self.size * SHM_SLOT.size + self._start(_key)
+        self._lock(_home)
+        try:
+            self._reset_stale(_key)
+            while True:
+                _target, _expected = self._choose(_key)
+                _offset = self._offset(_target)
+                self._lock(_offset)
+                try:
+                    # another key could take the slot meanwhile: choose again
+                    _seq, _current = struct.unpack_from('<IQ', self._mm, _offset)
+                    if _current != _expected:
+                        continue
+                    SHM_SEQ.pack_into(self._mm, _offset, (_seq + 1) & 0xffffffff)
+                    SHM_ENTRY.pack_into(self._mm, _offset + SHM_SEQ.size, _key, int(location[1]), _server,
+                                        int(time()) & 0xffffffff)
+                    SHM_SEQ.pack_into(self._mm, _offset, (_seq + 2) & 0xffffffff)
+                    break
+                finally:
+                    self._unlock(_offset)
+        finally:
+            self._unlock(_home)
+        return True
+
+    def discard(self, ProductID):
+        #   The location isn't kept in the table (the key stays in the slot for the probe sequence)
+        _key = self.key(ProductID)
+        if _key is None:
+            return
+        _home = SHM_SLOTS_OFFSET + self.size * SHM_SLOT.size + self._start(_key)
+        self._lock(_home)
+        try:
+            for _slot in self._probe(_key):
+                _offset = self._offset(_slot)
+                _seq, _current = struct.unpack_from('<IQ', self._mm, _offset)
+                if not _current:
+                    break
+                if _current != _key:
+                    continue
+                self._lock(_offset)
+                try:
+                    _seq = SHM_SEQ.unpack_from(self._mm, _offset)[0]
+                    SHM_SEQ.pack_into(self._mm, _offset, (_seq + 1) & 0xffffffff)
+                    SHM_ENTRY.pack_into(self._mm, _offset + SHM_SEQ.size, _key, 0, 0, 0)
+                    SHM_SEQ.pack_into(self._mm, _offset, (_seq + 2) & 0xffffffff)
+                finally:
+                    self._unlock(_offset)
+                break
+        finally:
+            self._unlock(_home)
+
+    def items(self, start=0, stop=None):
+        #   (ProductID, (server, port)) of the slots in use (of start..stop slots)
+        for _slot in xrange(start, self.size if stop is None else min(stop, self.size)):
+            _entry = self._read(_slot)
+            if _entry is not None and _entry[0] and _entry[2]:
+                yield str(_entry[0]), (self._server_name(_entry[2]), str(_entry[1]))
+
+    def memory(self):
+        #   Bytes mapped, doesn't depend on the number of entries
+        return self._length
+
+    def _reset_stale(self, key):
+        #   Slots of the probe sequence left odd by the crashed writer (the live one holds the slot lock)
+        for _slot in self._probe(key):
+            _offset = self._offset(_slot)
+            if not SHM_SEQ.unpack_from(self._mm, _offset)[0] & 1:
+                continue
+            self._lock(_offset)
+            try:
+                _seq = SHM_SEQ.unpack_from(self._mm, _offset)[0]
+                if _seq & 1:
+                    _key, _port, _server, _stamp = SHM_ENTRY.unpack_from(self._mm, _offset + SHM_SEQ.size)
+                    SHM_ENTRY.pack_into(self._mm, _offset + SHM_SEQ.size, _key, _port, _server, 0)
+                    SHM_SEQ.pack_into(self._mm, _offset, (_seq + 1) & 0xffffffff)
+                    gen_log.warning("shared directory '%s': slot %i left by the crashed writer is reset",
+                                    self.filename, _slot)
+            finally:
+                self._unlock(_offset)
+
+    def _choose(self, key):
+        #   (slot, key in the slot) for the key: the same key, empty slot or the oldest one
+        _oldest = None
+        for _slot in self._probe(key):
+            _entry = self._read(_slot)
+            if _entry is None:
+                continue
+            if not _entry[0] or _entry[0] == key:
+                return _slot, _entry[0]
+            if _oldest is None or _entry[3] < _oldest[2]:
+                _oldest = (_slot, _entry[0], _entry[3])
+        if _oldest is None:
+            _slot = self._start(key)
+            return _slot, struct.unpack_from('<Q', self._mm, self._offset(_slot) + SHM_SEQ.size)[0]
+        return _oldest[:2]
+
+    def _start(self, key):
+        return (crc32(struct.pack('<Q', key)) & 0xffffffff) % self.size
+
+    def _probe(self, key):
+        _start = self._start(key)
+        for _i in xrange(SHM_PROBE):
+            yield (_start + _i) % self.size
+
+    def _offset(self, slot):
+        return SHM_SLOTS_OFFSET + slot * SHM_SLOT.size
+
+    def _read(self, slot):
+        #   (key, port, server index, stamp) or None if the slot is being written
+        _offset = self._offset(slot)
+        for _i in xrange(SHM_READ_RETRIES):
+            _seq, _key, _port, _server, _stamp = SHM_SLOT.unpack_from(self._mm, _offset)
+            if _seq & 1:
+                continue
+            if SHM_SEQ.unpack_from(self._mm, _offset)[0] == _seq:
+                return _key, _port, _server, _stamp
+        return None
+
+    def _server_index(self, server):
+        if server in self._servers:
+            return self._servers[server]
+        if not self.fits(server):
+            raise ValueError, "Server name '%s' is longer than %i bytes" % (server, SHM_SERVER.size)
+        self._lock(0)
+        try:
+            _count = SHM_HEADER.unpack_from(self._mm, 0)[2]
+            for _index in xrange(1, _count + 1):
+                if self._read_server(_index) == server:
+                    break
+            else:
+                if _count >= SHM_SERVERS_MAX:
+                    raise EnvironmentError, "File '%s' can't keep more than %i servers" % \
+                                            (self.filename, SHM_SERVERS_MAX)
+                _index = _count + 1
+                SHM_SERVER.pack_into(self._mm, SHM_SERVERS_OFFSET + (_index - 1) * SHM_SERVER.size, server)
+                SHM_HEADER.pack_into(self._mm, 0, SHM_MAGIC, self.size, _index)
+        finally:
+            self._unlock(0)
+        self._servers[server] = _index
+        self._names[_index] = server
+        return _index
+
+    def _server_name(self, index):
+        if index not in self._names:
+            self._names[index] = self._read_server(index)
+            self._servers[self._names[index]] = index
+        return self._names[index]
+
+    def _read_server(self, index):
+        return SHM_SERVER.unpack_from(self._mm, SHM_SERVERS_OFFSET + (index - 1) * SHM_SERVER.size)[0].rstrip('\0')
+
+    def _lock(self, offset):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, offset)
+
+    def _unlock(self, offset):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+
+
+def location_directory():
+    #   Instance directory, sizes are taken from options
+    _directory = LocationDirectory(options.directory_max_entries, options.directory_ttl)
+    stats_mon.add_gauge('Directory_Entries', _directory.__len__)
+    stats_mon.add_gauge('Directory_Bytes_Per_Entry', lambda: _directory.memory() / max(len(_directory), 1))
+    return _directory
+
+
+def directory_log():
+    #   DirectoryLog of the instance if enabled
+    if options.directory_log:
+        return DirectoryLog(options.directory_log)
+    return None
+
+
+def shared_directory():
+    #   SharedDirectory of the server if enabled
+    if options.shm_directory:
+        return SharedDirectory(options.shm_directory, options.shm_directory_size)
+    return None
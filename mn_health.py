@@ -0,0 +1,165 @@
+""" Health of the other servers/instances (peers): circuit breaker per peer
+- closed: requests are sent, max_instance_failed failures in a row open the breaker;
+- open: the peer is skipped, it's probed after the backoff (exponential with jitter);
+- half-open: the probe is sent, success closes the breaker (the peer is re-admitted),
+  failure opens it again for twice longer (up to breaker_backoff_max).
+Round-trip time and error rate (EWMA) of every peer are measured by the requests sent to it
+and by the probes of the peers not asked for rtt_probe_period seconds; peers are tried in RTT order.
+"""
+__author__ = 'morozov'
+import random
+from time import time
+from tornado.log import access_log
+from tornado.options import define, options
+from mn_stats import stats_mon
+
+# seconds the breaker is open at first and at most
+define('breaker_backoff', default=1.0, type=float)
+define('breaker_backoff_max', default=60.0, type=float)
+# seconds without requests to the peer before its RTT is measured by a probe (0 - no probes)
+define('rtt_probe_period', default=30, type=int)
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half-open'
+
+PEER_RTT_ALPHA = 0.2        # EWMA weight of the last request RTT/result
+
+
+class Breaker:
+    def __init__(self, peer):
+        self.peer = peer
+        self.state = BREAKER_CLOSED
+        self.failures = 0           # in a row
+        self.opened = 0             # times opened since closed
+        self.retry = 0              # time to probe
+        self.changed = time()
+        self.error = None
+        self.rtt = None             # seconds
+        self.error_rate = 0.0
+        self.measured = 0           # time of the last request/probe
+
+    def failure(self, error=None):
+        #   Returns True if the breaker is opened
+        self.failures += 1
+        self.error = error and str(error)
+        self.measured = time()
+        self.error_rate = PEER_RTT_ALPHA + (1 - PEER_RTT_ALPHA) * self.error_rate
+        if self.state == BREAKER_OPEN or \
+           self.state == BREAKER_CLOSED and self.failures < options.max_instance_failed:
+            return False
+        _opened = self.state == BREAKER_CLOSED
+        self.opened += 1
+        _backoff = min(options.breaker_backoff * 2 ** (self.opened - 1), options.breaker_backoff_max)
+        self.retry = time() + _backoff * random.uniform(0.5, 1)
+        self._set(BREAKER_OPEN)
+        return _opened
+
+    def success(self, rtt=None):
+        #   Returns True if the breaker is closed (the peer is re-admitted)
+        self.failures = self.opened = 0
+        self.error = None
+        self.measured = time()
+        self.error_rate *= 1 - PEER_RTT_ALPHA
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else PEER_RTT_ALPHA * rtt + (1 - PEER_RTT_ALPHA) * self.rtt
+        if self.state == BREAKER_CLOSED:
+            return False
+        self._set(BREAKER_CLOSED)
+        return True
+
+    def probe(self):
+        #   Returns True if it's time to probe the open breaker or to measure RTT of the closed one
+        _now = time()
+        if self.state == BREAKER_CLOSED:
+            if not options.rtt_probe_period or self.measured > _now - options.rtt_probe_period:
+                return False
+            self.measured = _now
+            return True
+        if self.state != BREAKER_OPEN or self.retry > _now:
+            return False
+        self._set(BREAKER_HALF_OPEN)
+        return True
+
+    def cost(self):
+        #   Expected time to get the answer: RTT of the requests to be repeated on errors
+        if self.rtt is None:
+            return float('inf')
+        return self.rtt / max(1 - self.error_rate, 0.01)
+
+    def info(self):
+        return {'state': self.state, 'failures': self.failures, 'opened': self.opened, 'error': self.error,
+                'since': int(time() - self.changed),
+                'rtt': self.rtt and round(self.rtt*1000, 2), 'error_rate': round(self.error_rate, 3),
+                'retry': max(0, round(self.retry - time(), 1)) if self.state == BREAKER_OPEN else None}
+
+    def _set(self, state):
+        if state != self.state:
+            access_log.info('peer "%s": %s -> %s (%s)' % (self.peer, self.state, state, self.error or 'ok'))
+            self.state = state
+            self.changed = time()
+
+
+class PeerHealth:
+    #   Breakers of the peers:
+    #   probe(peer) is called to send the probe, on_open(peer)/on_close(peer) when the breaker is opened/closed
+    def __init__(self, probe, on_open=None, on_close=None):
+        self._breakers = {}
+        self._probe = probe
+        self._on_open = on_open
+        self._on_close = on_close
+        stats_mon.add_gauge('Peers_Open', self.opened)
+
+    def available(self, peer):
+        _breaker = self._breakers.get(peer)
+        return _breaker is None or _breaker.state == BREAKER_CLOSED
+
+    def order(self, peers):
+        #   Peers with closed breakers, the lowest RTT first (not measured ones last)
+        _unknown = Breaker(None)
+        return sorted((_peer for _peer in peers if self.available(_peer)),
+                      key=lambda _peer: self._breakers.get(_peer, _unknown).cost())
+
+    def rtt(self, peer):
+        #   ms, None if not measured
+        _breaker = self._breakers.get(peer)
+        return _breaker and _breaker.rtt and _breaker.rtt*1000
+
+    def _breaker(self, peer):
+        _breaker = self._breakers.get(peer)
+        if _breaker is None:
+            _breaker = self._breakers[peer] = Breaker(peer)
+            stats_mon.add_gauge('RTT_%s' % peer, lambda: self.rtt(peer) or 0.0)
+        return _breaker
+
+    def failure(self, peer, error=None):
+        _breaker = self._breaker(peer)
+        if _breaker.failure(error):
+            if options.stats_enabled:
+                stats_mon._count('Breaker_Opened')
+            if self._on_open:
+                self._on_open(peer)
+
+    def success(self, peer, rtt=None):
+        if self._breaker(peer).success(rtt) and self._on_close:
+            self._on_close(peer)
+
+    def alive(self, peer):
+        #   The peer talks to us: its breaker is closed
+        _breaker = self._breakers.get(peer)
+        if _breaker is not None and _breaker.state != BREAKER_CLOSED:
+            self.success(peer)
+
+    def check(self, peers=()):
+        #   Probes the peers whose backoff is over and the peers not asked for rtt_probe_period
+        for _peer in peers:
+            self._breaker(_peer)
+        for _breaker in self._breakers.values():
+            if _breaker.probe():
+                self._probe(_breaker.peer)
+
+    def opened(self):
+        return sum(1 for _breaker in self._breakers.itervalues() if _breaker.state != BREAKER_CLOSED)
+
+    def info(self):
+        return dict((_peer, _breaker.info()) for _peer, _breaker in self._breakers.iteritems())
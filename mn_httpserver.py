@@ -3,6 +3,8 @@ IOStream_np, HTTPConnection_np, HTTPServer_np, Application_np"""
 from __future__ import absolute_import, division, print_function, with_statement
 
 import socket
+import time
+import collections
 from tornado import httputil
 
 from tornado.httpserver import HTTPServer, HTTPRequest, HTTPConnection
@@ -11,11 +13,15 @@ from tornado.web import Application
 
 from tornado.tcpserver import ssl
 from tornado.iostream import IOStream, SSLIOStream, _merge_prefix
-from errno import ECONNABORTED, ECONNRESET, EWOULDBLOCK, EAGAIN
-from tornado.netutil import ssl_wrap_socket
+from errno import ECONNABORTED, ECONNRESET, EWOULDBLOCK, EAGAIN, EPIPE
+from tornado.netutil import ssl_wrap_socket, ssl_options_to_context
 from tornado.log import app_log
+from tornado.ioloop import PeriodicCallback
+from tornado.options import define, options
+from mn_stats import stats_mon
 
 from tornado.escape import native_str
+from tornado.httputil import _normalized_headers
 from tornado import stack_context
 import functools
 
@@ -68,14 +74,183 @@ def asynchronous(method):
     return wrapper
 
 
+# read buffers of all the connections (bytes): the ones to read ahead are smaller while it's exhausted
+define('stream_buffer_budget', default=64*1024*1024, type=int)
+# read buffer of idle connection (request headers, long-polling Desktop) and of the one transferring data
+define('stream_buffer_min', default=8192, type=int)
+define('stream_buffer_max', default=256*1024, type=int)
+
+# seconds the SSL session ticket key (and session cache) of the listener is used (0 - not replaced)
+define('ssl_ticket_rotation', default=3600, type=int)
+
+# requests served by a connection (0 - no keep-alive), seconds it waits for the next request
+define('keep_alive_requests', default=100, type=int)
+define('timeout_keep_alive', default=75, type=int)
+# seconds to receive request headers, seconds the read of request body / the response write
+# may make no progress (0 - no deadline)
+define('timeout_headers', default=30, type=int)
+define('timeout_body_idle', default=30, type=int)
+define('timeout_write_idle', default=60, type=int)
+
+READ_BUFFER_POOL = 64      # free read buffers of a size kept for other streams
+WRITE_GATHER_SIZE = 16384   # queued chunks are joined into one send up to this size
+KEEP_ALIVE_DRAIN = 65536    # unread request body up to this size is skipped to keep the connection
+REAPER_PERIOD = 2           # seconds between the deadline checks of the connections
+
+
+class BufferBudget:
+    #   Read buffers of all the streams within stream_buffer_budget:
+    #   sizes are powers of 2 from stream_buffer_min up to max_buffer_size of the stream,
+    #   free buffers are pooled by size. The buffer for the pending read is always given,
+    #   the one to read ahead (borrowed by the transfer) is smaller if the budget is exhausted:
+    #   reading of the stream is paused as soon as it's full
+    def __init__(self):
+        self.used = 0
+        self._free = {}
+        stats_mon.add_gauge('Buffer_Used', lambda: self.used // 1024)
+
+    def size(self, num_bytes, max_size):
+        _size = options.stream_buffer_min
+        while _size < num_bytes:
+            _size *= 2
+        return min(_size, max_size)
+
+    def acquire(self, size, need=0):
+        #   bytearray of the size or smaller one (but need bytes at least) if the budget is exhausted
+        if size > options.stream_buffer_min and self.used + size > options.stream_buffer_budget:
+            if options.stats_enabled:
+                stats_mon._count('Buffer_Denied')
+            while size > options.stream_buffer_min and size // 2 >= need and \
+                  self.used + size > options.stream_buffer_budget:
+                size //= 2
+        self.used += size
+        _free = self._free.get(size)
+        return _free.pop() if _free else bytearray(size)
+
+    def release(self, buf, reuse=True):
+        #   reuse=False: the buffer is still referred (data lent by the closed stream)
+        self.used -= len(buf)
+        _free = self._free.setdefault(len(buf), [])
+        if reuse and len(_free) < READ_BUFFER_POOL:
+            _free.append(buf)
+
+buffer_budget = BufferBudget()
+
+
+def _merge_str_prefix(deque, size):
+    #   _merge_prefix() of the leading str chunks only: memoryview chunks are sent as they are
+    _count = 0
+    for _chunk in deque:
+        if isinstance(_chunk, memoryview):
+            break
+        _count += 1
+    if not _count or (_count == 1 and len(deque[0]) <= size):
+        return
+    _prefix = collections.deque(deque.popleft() for _i in range(_count))
+    _merge_prefix(_prefix, size)
+    deque.extendleft(reversed(_prefix))
+
+
+def _gather_prefix(deque, size):
+    #   Joins the leading chunks (str and memoryview) into one send of up to size bytes,
+    #   e.g. response headers with the first chunk of the body
+    if len(deque) > 1 and len(deque[0]) + len(deque[1]) <= size:
+        _gathered = bytearray(deque.popleft())
+        while deque and len(_gathered) + len(deque[0]) <= size:
+            _gathered += deque.popleft()
+        deque.appendleft(memoryview(_gathered))
+    else:
+        _merge_str_prefix(deque, 128 * 1024)
+
+
 class IOStream_mn(IOStream):
     #   Uses small limited buffer to read data portions one by one;
     #   reads until buffer is full;
-    #   removes handler if _handle_read() occurs for stream with already full buffer
+    #   READ is off if _handle_read() occurs for stream with already full buffer (handler stays registered).
+    #   Read buffer is a bytearray taken from buffer_budget while the stream has unread data,
+    #   the socket is read into it by recv_into (no str per recv, no merging).
+    #   The buffer is stream_buffer_min unless a read or borrow() needs more (up to max_buffer_size);
+    #   reading is paused while it's full.
+    #   read_view() gives the data as memoryview of the buffer: the lent part isn't overwritten
+    #   until the next read of the stream, nor while the borrower stream has it queued
+    #   (the buffer is left to it then). write() takes memoryview as well.
+    #   Small queued chunks are sent by one send(); cork() holds the next write until the one after it.
+    #   on_drained() callbacks wait for the queued data besides the write callback (writers sharing the stream).
+    copies = 0      # str objects made by the read path
+    views = 0       # memoryview chunks given instead
+    sends = 0       # send syscalls
+
     def __init__(self, socket, *args, **kwargs):
         self.read_buffer_full = False
+        self.consumed = 0               # bytes read from the stream by its reads
+        self.received = self.sent = 0   # bytes read from / written to the socket
+        self._buf = self._buf_view = None
+        self._start = self._end = 0     # unread data of the buffer
+        self._lent = False              # memoryview of the consumed data is given
+        self._borrower = None           # stream the lent data are written to
+        self._read_view = False
+        self._corked = False
+        self._borrowed = 0              # bytes of the transfer to read ahead
+        self._drain_callbacks = []
         super(IOStream_mn, self).__init__(socket, *args, **kwargs)
 
+    def borrow(self, num_bytes):
+        #   num_bytes are to be read (data of the interaction): the buffer is as big as it's needed
+        #   for them (up to max_buffer_size) instead of the idle one
+        self._borrowed = num_bytes
+
+    def cork(self):
+        #   The next write is only queued (its callback is run at once): it's sent with the write after it
+        self._corked = True
+
+    def on_drained(self, callback):
+        #   Runs the callback when the queued data are sent or the stream is closed.
+        #   Unlike the write callback it isn't replaced by the next write: every writer
+        #   of the stream (interactions multiplexed over the Desktop channel) waits for it
+        _callback = stack_context.wrap(callback)
+        if self._write_buffer and not self.closed():
+            self._drain_callbacks.append(_callback)
+        else:
+            self.io_loop.add_callback(_callback)
+
+    def _run_drained(self):
+        _callbacks, self._drain_callbacks = self._drain_callbacks, []
+        for _callback in _callbacks:
+            self.io_loop.add_callback(_callback)
+
+    def read_view(self, num_bytes, callback, borrower=None):
+        #   read_bytes() which gives memoryview of the read buffer, valid until the next read of the stream.
+        #   borrower - stream the data are written to: the buffer isn't reused while it has them queued
+        self._read_view = True
+        self._borrower = borrower
+        self.read_bytes(num_bytes, callback)
+
+    def feed(self, data):
+        #   Data read from the socket by another process (handed over connection): they are read first
+        _size = max(buffer_budget.size(len(data) + self.read_chunk_size, self.max_buffer_size), len(data))
+        self._buf = buffer_budget.acquire(_size, len(data))
+        self._buf_view = memoryview(self._buf)
+        self._buf[:len(data)] = data
+        self._start, self._end = 0, len(data)
+        self._read_buffer_size = len(data)
+
+    def unread(self):
+        #   Data read from the socket but not consumed yet
+        return self._buf_view[self._start:self._end].tobytes() if self._buf is not None else b''
+
+    def read_into_fd(self, view):
+        #   read_from_fd() into the buffer: returns the number of bytes read, None if nothing to read
+        try:
+            num_bytes = self.socket.recv_into(view)
+        except socket.error as e:
+            if e.args[0] in (EWOULDBLOCK, EAGAIN):
+                return None
+            raise
+        if not num_bytes:
+            self.close()
+            return None
+        return num_bytes
+
     def _read_to_buffer(self):
         #   Reads from the socket and appends the result to the read buffer.
         #   Returns the number of bytes read.  Returns 0 if there is nothing
@@ -87,33 +262,250 @@ class IOStream_mn(IOStream):
         #   check .max_buffer_size
         self.read_buffer_full = self._read_buffer_size + self.read_chunk_size > self.max_buffer_size
         if self.read_buffer_full:
+            if self._read_bytes is None and self._unsatisfied():
+                # e.g. request headers are too long
+                gen_log.error("Reached maximum read buffer size")
+                self.close()
+                raise IOError("Reached maximum read buffer size")
             return 0
         # --------------------------
+        if self._buf is None:
+            self._acquire()
+        if self._end == len(self._buf):
+            self._compact()
+            if self._end == len(self._buf) and not self._grow():
+                # the lent data are not written yet / the pending read has got its data
+                self.read_buffer_full = True
+                return 0
         try:
-            chunk = self.read_from_fd()
+            num_bytes = self.read_into_fd(self._buf_view[self._end:])
         except (socket.error, IOError, OSError) as e:
             if e.args[0] == ECONNRESET:
                 self.close(exc_info=True)
                 return
             self.close(exc_info=True)
             raise
-        if chunk is None:
+        if num_bytes is None:
             return 0
-        self._read_buffer.append(chunk)
-        self._read_buffer_size += len(chunk)
-        #actually should not happen, but... just in case
-        if self._read_buffer_size > self.max_buffer_size:
-            gen_log.error("Reached maximum read buffer size")
-            self.close()
-            raise IOError("Reached maximum read buffer size")
-        return len(chunk)
+        self._end += num_bytes
+        self.received += num_bytes
+        self._read_buffer_size += num_bytes
+        return num_bytes
+
+    def _read_from_buffer(self):
+        #   tornado version searching the delimiter/regex in the buffer itself
+        if self._streaming_callback is not None and self._read_buffer_size:
+            bytes_to_consume = self._read_buffer_size
+            if self._read_bytes is not None:
+                bytes_to_consume = min(self._read_bytes, bytes_to_consume)
+                self._read_bytes -= bytes_to_consume
+            self._run_callback(self._streaming_callback,
+                               self._consume(bytes_to_consume))
+        if self._read_bytes is not None and self._read_buffer_size >= self._read_bytes:
+            num_bytes = self._read_bytes
+            callback = self._read_callback
+            self._read_callback = None
+            self._streaming_callback = None
+            self._read_bytes = None
+            self._run_callback(callback, self._consume(num_bytes))
+            return True
+        elif self._read_delimiter is not None:
+            if self._read_buffer_size:
+                loc = self._buf.find(self._read_delimiter, self._start, self._end)
+                if loc != -1:
+                    callback = self._read_callback
+                    delimiter_len = len(self._read_delimiter)
+                    self._read_callback = None
+                    self._streaming_callback = None
+                    self._read_delimiter = None
+                    self._run_callback(callback, self._consume(loc - self._start + delimiter_len))
+                    return True
+        elif self._read_regex is not None:
+            if self._read_buffer_size:
+                m = self._read_regex.search(self._buf, self._start, self._end)
+                if m is not None:
+                    callback = self._read_callback
+                    self._read_callback = None
+                    self._streaming_callback = None
+                    self._read_regex = None
+                    self._run_callback(callback, self._consume(m.end() - self._start))
+                    return True
+        return False
+
+    def _consume(self, loc):
+        if loc == 0:
+            return b""
+        _start = self._start
+        self._start += loc
+        self.consumed += loc
+        self._read_buffer_size -= loc
+        self._borrowed = max(0, self._borrowed - loc)
+        if self._read_view:
+            self._read_view = False
+            self._lent = True
+            IOStream_mn.views += 1
+            data = self._buf_view[_start:self._start]
+        else:
+            IOStream_mn.copies += 1
+            data = self._buf_view[_start:self._start].tobytes()
+        if self._start == self._end and not self._lent:
+            self._release()
+        return data
+
+    def _set_read_callback(self, callback):
+        #   The next read: the lent data are done with
+        super(IOStream_mn, self)._set_read_callback(callback)
+        if self._lent:
+            self._lent = False
+            if self._lent_queued():
+                self._detach()
+            elif self._start == self._end:
+                self._release()
+            self._borrower = None
+
+    def _lent_queued(self):
+        #   The borrower may still have the lent data queued
+        return self._borrower is not None and self._borrower.writing()
+
+    def _detach(self):
+        #   The buffer is left to the queued views of the lent data: unread data move to a new one
+        _view, _start, _end = self._buf_view, self._start, self._end
+        self._release(reuse=False)
+        if _end > _start:
+            _size = buffer_budget.size(self._needed(), self.max_buffer_size)
+            self._buf = buffer_budget.acquire(_size, _size)
+            self._buf_view = memoryview(self._buf)
+            self._buf[:_end - _start] = _view[_start:_end]
+            self._end = _end - _start
+
+    def _needed(self):
+        #   Buffer size for the unread data and the pending read
+        return max(self._read_buffer_size + 1, self._read_bytes or 0)
+
+    def _acquire(self):
+        _size = max(self._read_bytes or 0, self._borrowed) + self.read_chunk_size
+        self._buf = buffer_budget.acquire(buffer_budget.size(_size, self.max_buffer_size), self._needed())
+        self._buf_view = memoryview(self._buf)
+        self._start = self._end = 0
+
+    def _unsatisfied(self):
+        #   The pending read needs more data than the buffer holds
+        if self._read_bytes is not None:
+            return self._read_bytes > self._read_buffer_size
+        if self._buf is None:
+            return self._read_delimiter is not None or self._read_regex is not None
+        if self._read_delimiter is not None:
+            return self._buf.find(self._read_delimiter, self._start, self._end) == -1
+        if self._read_regex is not None:
+            return self._read_regex.search(self._buf, self._start, self._end) is None
+        return False
+
+    def _grow(self):
+        #   Bigger buffer if the pending read needs more data than the buffer holds
+        #   (long request headers, read_bytes() of a bigger chunk); not while the lent data are not written yet
+        if self._lent or not self._unsatisfied():
+            return False
+        _size = buffer_budget.size(max(self._needed(), len(self._buf) + 1), self.max_buffer_size)
+        if _size <= len(self._buf):
+            return False
+        _buf = buffer_budget.acquire(_size, _size)
+        _size = self._end - self._start
+        _buf[:_size] = self._buf_view[self._start:self._end]
+        buffer_budget.release(self._buf)
+        self._buf = _buf
+        self._buf_view = memoryview(self._buf)
+        self._start, self._end = 0, _size
+        return True
+
+    def _release(self, reuse=True):
+        #   No unread data: the buffer goes back to buffer_budget
+        if self._buf is not None:
+            buffer_budget.release(self._buf, reuse)
+        self._buf = self._buf_view = None
+        self._start = self._end = 0
+
+    def _compact(self):
+        #   Moves unread data to the buffer start unless the consumed data are lent
+        if self._lent or not self._start:
+            return
+        _size = self._end - self._start
+        if _size:
+            self._buf[:_size] = self._buf_view[self._start:self._end].tobytes()
+        self._start, self._end = 0, _size
+
+    def close(self, exc_info=False):
+        super(IOStream_mn, self).close(exc_info)
+        # unread data go back with the buffer: tornado tries the pending read once more after close()
+        self._read_buffer_size = 0
+        self._release(reuse=not (self._lent or self._lent_queued()))
+        self._run_drained()
+
+    def _maybe_add_error_listener(self):
+        #   READ is added back if it's off because of the full buffer
+        if self._state is not None and not self._state & self.io_loop.READ and \
+           not self.read_buffer_full and not self.closed():
+            self._add_io_state(self.io_loop.READ)
+        else:
+            super(IOStream_mn, self)._maybe_add_error_listener()
+
+    def write(self, data, callback=None):
+        #   Takes memoryview as well: it's written as is
+        if not isinstance(data, memoryview) and not self._corked:
+            return super(IOStream_mn, self).write(data, callback)
+        self._check_closed()
+        if len(data):
+            self._write_buffer.append(data)
+        if self._corked:
+            self._corked = False
+            if callback:
+                self._run_callback(stack_context.wrap(callback))
+            return
+        self._write_callback = stack_context.wrap(callback)
+        if not self._connecting:
+            self._handle_write()
+            if self._write_buffer:
+                self._add_io_state(self.io_loop.WRITE)
+            self._maybe_add_error_listener()
+
+    def _handle_write(self):
+        #   tornado version which gathers small chunks (memoryview ones aren't merged otherwise:
+        #   they are sliced after a partial send)
+        while self._write_buffer:
+            try:
+                _gather_prefix(self._write_buffer, WRITE_GATHER_SIZE)
+                IOStream_mn.sends += 1
+                num_bytes = self.write_to_fd(self._write_buffer[0])
+                if num_bytes == 0:
+                    break
+                self.sent += num_bytes
+                _chunk = self._write_buffer[0]
+                if num_bytes < len(_chunk):
+                    self._write_buffer[0] = _chunk[num_bytes:]
+                else:
+                    self._write_buffer.popleft()
+            except (socket.error, IOError, OSError) as e:
+                if e.args[0] in (EWOULDBLOCK, EAGAIN):
+                    break
+                else:
+                    if e.args[0] not in (ECONNRESET, EPIPE):
+                        gen_log.warning("Write error on %d: %s",
+                                        self.fileno(), e)
+                    self.close(exc_info=True)
+                    return
+        if not self._write_buffer and self._write_callback:
+            callback = self._write_callback
+            self._write_callback = None
+            self._run_callback(callback)
+        if not self._write_buffer and self._drain_callbacks:
+            self._run_drained()
 
     def _handle_events(self, fd, events):
-        #   Temporary removes handler if _handle_read() occurs stream with full buffer
+        #   Temporary turns READ off if _handle_read() occurs for stream with full buffer
         if self.closed():
             gen_log.warning("Got events for closed stream %d", fd)
             return
         try:
+            _full = self.read_buffer_full
             if events & self.io_loop.READ:
                 self._handle_read()
             if self.closed():
@@ -138,15 +530,12 @@ class IOStream_mn(IOStream):
                 state |= self.io_loop.WRITE
             if state == self.io_loop.ERROR:
                 state |= self.io_loop.READ
-                # -- removes handler if buffer is already full
-                if self.read_buffer_full:
-                    state=None
-            if state is None:
-                self._state = state
-                self.io_loop.remove_handler(self.fileno())
-                # gen_log.warning('%d handler has been removed',self.fileno())
-                # -- handler is to be added back in run_callback (tornado code)
-            elif state != self._state:
+            if self.read_buffer_full and _full and events & self.io_loop.READ:
+                # -- woken up with the buffer still full: READ is off until there is room in the buffer
+                # -- (_maybe_add_error_listener), the handler stays registered.
+                # -- The buffer is usually read before the next poll: READ isn't toggled for every chunk
+                state &= ~self.io_loop.READ
+            if state != self._state:
                 assert self._state is not None,\
                 "shouldn't happen: _handle_events without self._state"
                 self._state = state
@@ -158,35 +547,231 @@ class IOStream_mn(IOStream):
             raise
 
 
+class SSLSessions:
+    #   One SSLContext for all the connections of the SSL listener: clients resume their sessions
+    #   (session cache, session tickets) instead of the full handshake on every request.
+    #   (tornado makes new SSLContext of ssl_options dict for every connection: no resumption)
+    #   The context is replaced every ssl_ticket_rotation seconds: new ticket key, empty cache.
+    #   Stats: SSL_Handshakes of the period and SSL_Resumed % of them.
+    def __init__(self, ssl_options):
+        self._ssl_options = ssl_options
+        self._replaced = {'accept_good': 0, 'hits': 0}  # session stats of the replaced contexts
+        self._last_handshakes = dict(self._replaced)
+        self._last_resumed = dict(self._replaced)
+        self.context = ssl_options_to_context(ssl_options)
+        if hasattr(ssl, 'SSLContext') and isinstance(self.context, ssl.SSLContext):
+            if options.ssl_ticket_rotation:
+                PeriodicCallback(self.rotate, options.ssl_ticket_rotation * 1000).start()
+            stats_mon.add_gauge('SSL_Handshakes', self._handshakes)
+            stats_mon.add_gauge('SSL_Resumed', self._resumed)
+
+    def rotate(self):
+        _stats = self.context.session_stats()
+        for key in self._replaced:
+            self._replaced[key] += _stats[key]
+        self.context = ssl_options_to_context(self._ssl_options)
+
+    def _period(self, last):
+        #   Session stats since the last call
+        _stats = self.context.session_stats()
+        _values = {}
+        for key in last:
+            _total = self._replaced[key] + _stats[key]
+            _values[key] = _total - last[key]
+            last[key] = _total
+        return _values
+
+    def _handshakes(self):
+        return self._period(self._last_handshakes)['accept_good']
+
+    def _resumed(self):
+        #   % of the period handshakes
+        _values = self._period(self._last_resumed)
+        return 100.0 * _values['hits'] / _values['accept_good'] if _values['accept_good'] else 0.0
+
+
 class SSLIOStream_mn(SSLIOStream):
-    #   SSL-connection is handled by reverse-proxy server now (nginx).
-    #   No longer needs to have special class here.
-    pass
+    #   SSL-connection is handled by reverse-proxy server (nginx) unless certfile/keyfile are set
+    #   (sessions are resumed by SSLSessions of the listener then).
+    #   Counts bytes read / written (progress of the connection for the reaper).
+    received = sent = 0
+
+    def read_from_fd(self):
+        chunk = super(SSLIOStream_mn, self).read_from_fd()
+        if chunk:
+            self.received += len(chunk)
+        return chunk
+
+    def write_to_fd(self, data):
+        num_bytes = super(SSLIOStream_mn, self).write_to_fd(data)
+        self.sent += num_bytes
+        return num_bytes
 
 
 class StreamClosedWarning(IOError):
     pass
 
 
+# request headers used by the handlers, HTTPRequest and HTTPConnection for every request (and X-IWP-*)
+_EAGER_NAMES = frozenset(['Content-Length', 'Content-Type', 'Expect', 'Host', 'Connection',
+                          'X-Real-Ip', 'X-Forwarded-For'])
+_EAGER_FIRST = 'CcEeHhXx'
+
+
+class LazyHTTPHeaders(httputil.HTTPHeaders):
+    #   Request headers: X-IWP-* and the fields of _EAGER_NAMES are picked out of the raw header block
+    #   in one pass (lines are skipped by the first letter); the whole block is parsed the HTTPHeaders way
+    #   only when another field is asked for, the headers are listed or changed.
+    def __init__(self, data):
+        dict.__init__(self)
+        self._as_list = _as_list = {}
+        self._last_key = None
+        self._raw = None
+        if '\n ' in data or '\n\t' in data:
+            # folded (multi-line) header
+            self._parse(data)
+            return
+        for line in data.split('\r\n'):
+            if line and line[0] in _EAGER_FIRST:
+                name, sep, value = line.partition(':')
+                name = _normalized_headers[name]
+                if name in _EAGER_NAMES or name.startswith('X-Iwp-'):
+                    value = value.strip()
+                    if name in _as_list:
+                        _as_list[name].append(value)
+                        dict.__setitem__(self, name, dict.__getitem__(self, name) + ',' + value)
+                    else:
+                        _as_list[name] = [value]
+                        dict.__setitem__(self, name, value)
+        self._raw = data
+
+    def _parse(self, data=None):
+        if data is None:
+            data, self._raw = self._raw, None
+            dict.clear(self)
+            self._as_list.clear()
+        for line in data.splitlines():
+            if line:
+                httputil.HTTPHeaders.parse_line(self, line)
+
+    def _name(self, name):
+        #   Normalized name, the block is parsed unless the header is picked out already
+        name = _normalized_headers[name]
+        if self._raw is not None and name not in _EAGER_NAMES and not name.startswith('X-Iwp-'):
+            self._parse()
+        return name
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, self._name(name))
+
+    def __contains__(self, name):
+        return dict.__contains__(self, self._name(name))
+
+    def get(self, name, default=None):
+        return dict.get(self, self._name(name), default)
+
+    def get_list(self, name):
+        return self._as_list.get(self._name(name), [])
+
+    def __nonzero__(self):
+        return self._raw is not None or dict.__len__(self) > 0
+    __bool__ = __nonzero__
+
+
+def _parsed(method):
+    #   LazyHTTPHeaders method which needs the whole block parsed
+    def wrapper(self, *args, **kwargs):
+        if self._raw is not None:
+            self._parse()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+for _method in ('add', 'get_all', 'parse_line', '__setitem__', '__delitem__', 'update', 'copy',
+                'keys', 'values', 'items', 'iterkeys', 'itervalues', 'iteritems', '__iter__', '__len__',
+                '__repr__', '__eq__', '__ne__', 'pop', 'popitem', 'setdefault', 'clear'):
+    if hasattr(httputil.HTTPHeaders, _method):
+        setattr(LazyHTTPHeaders, _method, _parsed(getattr(httputil.HTTPHeaders, _method)))
+
+
+class ConnectionReaper:
+    #   Deadlines of the connection phases, checked by one sweep every REAPER_PERIOD seconds
+    #   instead of a timer per connection:
+    #   'headers' - request headers are received within timeout_headers seconds,
+    #   'idle' - kept alive connection waits for the next request up to timeout_keep_alive seconds,
+    #   'body' - the pending read of the request body gets data at least every timeout_body_idle seconds,
+    #   'write' - the response is sent on at least every timeout_write_idle seconds.
+    #   The request waiting for its partner (long-polling Desktop, App waiting for reply) has no deadline here:
+    #   the handlers have their own timeouts. Stats: Reaped_<phase>.
+    def __init__(self):
+        self._connections = set()
+        self._periodic = None
+
+    def add(self, connection):
+        if self._periodic is None:
+            self._periodic = PeriodicCallback(self._sweep, REAPER_PERIOD * 1000)
+            self._periodic.start()
+        connection._reap_state = None
+        connection._reap_since = 0
+        self._connections.add(connection)
+
+    def remove(self, connection):
+        self._connections.discard(connection)
+
+    def _sweep(self):
+        _now = time.time()
+        _timeouts = {'headers': options.timeout_headers, 'idle': options.timeout_keep_alive,
+                     'body': options.timeout_body_idle, 'write': options.timeout_write_idle}
+        for _connection in list(self._connections):
+            if _connection.stream.closed():
+                self._connections.discard(_connection)
+                continue
+            # the phase with its progress mark: the deadline is counted from the last change of them
+            _state = _connection.phase()
+            if _state != _connection._reap_state:
+                _connection._reap_state = _state
+                _connection._reap_since = _now
+                continue
+            _phase = _state[0]
+            if _phase is None or not _timeouts[_phase] or _now - _connection._reap_since < _timeouts[_phase]:
+                continue
+            gen_log.info('%s deadline: connection from %r closed', _phase, _connection.address)
+            if options.stats_enabled:
+                stats_mon._count('Reaped_' + _phase)
+            self._connections.discard(_connection)
+            # not HTTPConnection.close(): the handler is told by on_connection_close()
+            _connection.stream.close()
+
+connection_reaper = ConnectionReaper()
+
+
 class HTTPServer_mn ( HTTPServer ):
     #   Uses class with overridden methods instead of standard Tornado ones
+    handoff = None      # mn_workers.Handoff: requests of other workers' ProductIDs are handed over to them
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.ssl_sessions = SSLSessions(self.ssl_options) if self.ssl_options is not None else None
+
     def handle_stream(self, stream, address):
         #   Uses HTTPConnection_mn instead
-        no_keep_alive = True
+        no_keep_alive = not options.keep_alive_requests
         if issubclass(type(stream), SSLIOStream):
             protocol = 'https'
         else:
             protocol = 'http'
         HTTPConnection_mn(stream, address, self.request_callback,
-            no_keep_alive, self.xheaders, protocol)
+            no_keep_alive, self.xheaders, protocol, handoff=self.handoff)
 
-    def _handle_connection(self, connection, address):
-        #   Uses IOStream_mn/SSLIOStream_mn with small buffer instead
+    def _handle_connection(self, connection, address, data=None):
+        #   Uses IOStream_mn/SSLIOStream_mn with small buffer instead;
+        #   data - already read from the handed over connection
+        if options.stats_enabled and data is None:
+            stats_mon._count('Connections')
         if self.ssl_options is not None:
             assert ssl, "Python 2.6+ and OpenSSL required for SSL"
             try:
                 connection = ssl_wrap_socket(connection,
-                    self.ssl_options,
+                    self.ssl_sessions.context,
                     server_side=True,
                     do_handshake_on_connect=False)
             except ssl.SSLError as err:
@@ -201,9 +786,11 @@ class HTTPServer_mn ( HTTPServer ):
                     raise
         try:
             if self.ssl_options is not None:
-                stream = SSLIOStream_mn(connection, io_loop=self.io_loop, max_buffer_size=1024*64)
+                stream = SSLIOStream_mn(connection, io_loop=self.io_loop, max_buffer_size=options.stream_buffer_max)
             else:
-                stream = IOStream_mn(connection, io_loop=self.io_loop, max_buffer_size=1024*64)
+                stream = IOStream_mn(connection, io_loop=self.io_loop, max_buffer_size=options.stream_buffer_max)
+                if data:
+                    stream.feed(data)
             self.handle_stream(stream, address)
         except Exception:
             app_log.error("Error in connection callback", exc_info=True)
@@ -211,11 +798,68 @@ class HTTPServer_mn ( HTTPServer ):
 
 class HTTPConnection_mn (HTTPConnection):
     #   No "Content-Length too long" exception;
-    #   Reads headers only, body is to be read later.
+    #   Reads headers only, body is to be read later;
+    #   the request of another worker's ProductID is handed over to the worker.
+    #   Keep-alive: up to keep_alive_requests requests, the connection waits for the next one
+    #   up to timeout_keep_alive seconds (connection_reaper); it's closed if the handler left the request body unread
+    #   (unless the rest of it is small: it's skipped). The last response has 'Connection: close'.
+    def __init__(self, *args, **kwargs):
+        self.handoff = kwargs.pop('handoff', None)
+        self._requests = 0
+        self._body_end = 0              # stream.consumed at the end of the request body
+        self._response_started = False
+        self._draining = False
+        self._drain_callback = stack_context.wrap(self._on_drained)
+        HTTPConnection.__init__(self, *args, **kwargs)
+        connection_reaper.add(self)
+
+    def phase(self):
+        #   (phase, progress mark) of the connection for connection_reaper
+        if self._request is None:
+            if self._requests and not self.stream._read_buffer_size:
+                return 'idle', None
+            return 'headers', None
+        if self.stream.writing() and self.stream._state is not None and self.stream._state & self.stream.io_loop.WRITE:
+            # not just queued (the response headers held back by cork())
+            return 'write', self.stream.sent
+        if self.stream.reading():
+            return 'body', self.stream.received
+        return None, None
+
+    def _body_unread(self):
+        #   Bytes of the request body the handler hasn't read (the whole body if the stream doesn't count them)
+        if self._body_end and hasattr(self.stream, 'consumed'):
+            return max(0, self._body_end - self.stream.consumed)
+        return self._body_end
+
+    def _finish_request(self):
+        if self._draining:
+            # finished as soon as the body is skipped
+            return
+        if not self.no_keep_alive and self._request is not None:
+            _unread = self._body_unread()
+            if _unread:
+                if _unread <= KEEP_ALIVE_DRAIN and hasattr(self.stream, 'consumed') and \
+                   not self.stream.reading() and not self.stream.closed():
+                    self._draining = True
+                    self.stream.read_bytes(_unread, self._drain_callback)
+                    return
+                self.no_keep_alive = True
+        HTTPConnection._finish_request(self)
+
+    def _on_drained(self, data):
+        self._draining = False
+        self._finish_request()
+
+    def _on_connection_close(self):
+        connection_reaper.remove(self)
+        HTTPConnection._on_connection_close(self)
+
     def _on_headers(self, data):
         #   Request body is not read here
         try:
-            data = native_str(data.decode('latin1'))
+            if not isinstance(data, str):
+                data = data.decode('latin1')
             eol = data.find("\r\n")
             start_line = data[:eol]
             try:
@@ -224,7 +868,19 @@ class HTTPConnection_mn (HTTPConnection):
                 raise _BadRequestException("Malformed HTTP request line")
             if not version.startswith("HTTP/"):
                 raise _BadRequestException("Malformed HTTP version in HTTP Request-Line")
-            headers = httputil.HTTPHeaders.parse(data[eol:])
+            headers = LazyHTTPHeaders(data[eol:])
+
+            if self.handoff is not None:
+                _worker = self.handoff.worker(headers)
+                if _worker is not None and self.handoff.send(self.stream, data, _worker):
+                    return
+
+            self._requests += 1
+            self._response_started = False
+            if self._requests > 1 and options.stats_enabled:
+                stats_mon._count('Keep_Alive_Reused')
+            if options.keep_alive_requests and self._requests >= options.keep_alive_requests:
+                self.no_keep_alive = True
 
             # HTTPRequest wants an IP, not a full socket address
             if self.address_family in (socket.AF_INET, socket.AF_INET6):
@@ -238,8 +894,10 @@ class HTTPConnection_mn (HTTPConnection):
                 headers=headers, remote_ip=remote_ip, protocol=self.protocol)
 
             content_length = headers.get("Content-Length")
+            self._body_end = 0
             if content_length:
                 content_length = int(content_length)
+                self._body_end = getattr(self.stream, 'consumed', 0) + content_length
                 if content_length > self.stream.max_buffer_size:
                     pass
                 if headers.get("Expect") == "100-continue":
@@ -247,15 +905,22 @@ class HTTPConnection_mn (HTTPConnection):
 
             self.request_callback(self._request)
         except _BadRequestException as e:
-            gen_log.info("Malformed HTTP request from %s: %s",
-                self.address[0], e)
+            gen_log.info("Malformed HTTP request from %r: %s",
+                self.address, e)
             self.close()
             return
 
     def write(self, chunk, callback=None, error_on_closed=False):
         #   Writes a chunk of output to the stream. Warning if it's closed
         assert self._request, "Request closed"
+        if not self._response_started:
+            # the first chunk is the header block
+            self._response_started = True
+            if self.no_keep_alive and isinstance(chunk, bytes) and self._request.supports_http_1_1():
+                chunk = chunk.replace(b"\r\n", b"\r\nConnection: close\r\n", 1)
         if not self.stream.closed():
+            if isinstance(chunk, memoryview) and not isinstance(self.stream, IOStream_mn):
+                chunk = chunk.tobytes()
             self._write_callback = stack_context.wrap(callback)
             self.stream.write(chunk, self._on_write_complete)
         elif chunk:
@@ -8,10 +8,29 @@ __author__ = 'morozov'
 
 import tornado.httpclient
 import os
+import socket
+import zlib
+from time import time
+from functools import partial
+from itertools import chain, islice
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import RequestHandler
+from tornado.netutil import Resolver
+from tornado.concurrent import return_future
 from tornado.log import access_log, app_log, gen_log
 from tornado.options import define, options
+from tornado.httputil import HTTPHeaders
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    CurlAsyncHTTPClient = None
 from mynotes import MN_PRODUCT_ID, MN_RESPONSE_TYPE, MN_NO_AGENT
+import mynotes
+import mn_directory
+import mn_ring
+import mn_range
+import mn_health
+from mn_stats import stats_mon
 
 MN_INSTANCE_SERVER = "X-IWP-Host"
 MN_INSTANCE_PORT = "X-IWP-Port"
@@ -22,8 +41,76 @@ MN_INSTANCE_RANGE_TO = "X-IWP-Range-To"
 MN_INSTANCE_RANGE_SIZE = "X-IWP-Range-Size"
 MN_TARGET_SERVER = "X-IWP-Target-Host"
 MN_TARGET_PORT = "X-IWP-Target-Port"
+MN_PROXIED = "X-IWP-Proxied"
+
+MN_LOCALHOST = 'localhost'
+MN_DIGEST_FRESH = 3     # digest periods a received digest is used for
+MN_BODY_CHUNK = 16384   # request body is read by chunks: the stream buffer is limited
+MN_SNAPSHOT_BATCH = 5000    # directory entries per snapshot chunk
+MN_HANDOVER_DELAY = 5       # seconds the ring changes are gathered before the handover (flapping breakers)
+MN_HANDOVER_BATCH = 5000    # locations checked per handover step (IOLoop iteration)
+MN_HANDOVER_NOTIFY = 500    # 'connected' notifications per handover step
+MN_HANDOVER_PERIOD = 0.1    # seconds between the handover steps which sent MN_HANDOVER_NOTIFY
 
 define('max_instance_failed', default=5, type=int)
+# unix socket path template for same-server instances, e.g. 'run/%s.sock' (%s is the port)
+define('unix_socket', default=None, type=str)
+# consistent hashing: every ProductID has a home instance told where its Desktop is
+define('ring_enabled', default=False, type=bool)
+define('ring_vnodes', default=64, type=int)
+# Desktop search: ask all the instances/servers at once (True) or one by one
+define('find_parallel', default=True, type=bool)
+define('timeout_find', default=3, type=int)
+
+# seconds to remember ProductID is not found, seconds between digests of the instance Desktops (0 - no digests)
+define('timeout_miss', default=5, type=int)
+define('digest_period', default=60, type=int)
+
+# (re)started instance pulls the directory from another instance/server after 'hello', seconds to wait for it
+define('snapshot_enabled', default=True, type=bool)
+define('timeout_snapshot', default=60, type=int)
+# bootstrap: 'hello's sent at once, seconds the instance may take to get ready (directory and range)
+define('bootstrap_concurrency', default=16, type=int)
+define('timeout_bootstrap', default=120, type=int)
+# Mobile app request is passed to the instance of its Desktop instead of the referral
+# if its body is up to proxy_max_body bytes and the instance RTT is up to proxy_max_rtt ms
+define('proxy_enabled', default=False, type=bool)
+define('proxy_max_body', default=65536, type=int)
+define('proxy_max_rtt', default=50, type=int)
+define('timeout_proxy', default=60, type=int)
+
+
+def unix_socket_path(port):
+    #   Unix domain socket the instance listens to (None if disabled)
+    if options.unix_socket:
+        return options.unix_socket % str(port)
+    return None
+
+
+class UnixResolver(Resolver):
+    #   Resolves 'localhost:<port>' to the unix socket of the same-server instance;
+    #   falls back to the wrapped resolver (TCP loopback) if there is no such socket
+    def initialize(self, resolver):
+        self.resolver = resolver
+
+    def close(self):
+        self.resolver.close()
+
+    @return_future
+    def resolve(self, host, port, family=socket.AF_UNSPEC, callback=None):
+        _path = unix_socket_path(port) if host == MN_LOCALHOST else None
+        if _path and os.path.exists(_path):
+            callback([(socket.AF_UNIX, _path)])
+        else:
+            self.resolver.resolve(host, port, family, callback=callback)
+
+
+def _set_unix_resolver():
+    if options.unix_socket:
+        tornado.httpclient.AsyncHTTPClient.configure(None, resolver=UnixResolver(resolver=Resolver()))
+
+options.add_parse_callback(_set_unix_resolver)
+
 
 class mn_instance():
     #   Cloud service instance:
@@ -46,21 +133,40 @@ class mn_instance():
 
         assert range_file
         self.range_file = range_file
-        self._range_fd = None
-        self._range_requests = None
-        self._need_range = False
+        self._range = mn_range.RangeAllocator(range_file, create_if_no=True)
+        self._range_requests = None     # [servers, ports] to ask for the range while it's requested
         self.range_size = range_size
 
         self._servers = []
         self._instances = []
-        self._IDs = {}
-        self._failed = {}
+        self._IDs = mn_directory.location_directory()
+        self._misses = mn_directory.MissCache(options.timeout_miss)
+        self._digests = {}      # (server, port) -> (received, BloomFilter, ports of the server)
+        self._shm = mn_directory.shared_directory()
+        self._unshared = set()      # servers whose locations the shared directory can't keep
+        if self._shm:
+            if not self._shm.fits(self.server):
+                raise EnvironmentError, "Server name '%s' doesn't fit the shared directory (%i bytes max)" % \
+                                        (self.server, mn_directory.SHM_SERVER.size)
+            for _server in set([_instance[0] for _instance in known_instances or []]):
+                if not self._shm.fits(_server):
+                    app_log.warning("Server name '%s' doesn't fit the shared directory, "
+                                    "its locations are kept in the instance memory", _server)
+        self._log = mn_directory.directory_log()
+        self._health = mn_health.PeerHealth(self._probe, self._peer_opened, self._peer_closed)
         self._initialized = False
         self._hello_headers = {MN_INSTANCE_SERVER:self.server, MN_INSTANCE_PORT:self.port}
         self._hello_awaiting =0
+        self._hello_queue = []      # [{'server':...} or {'port':...}, ...] to say 'hello' to
+        self.ready = False          # directory and range are got: Desktops and Mobile apps are served
+        self._directory_ready = False
+        self._bootstrap_started = time()
+        self._bootstrap_time = None
 
+        self._master_range = None
         if self.master:
-            _master_range = self._range_from_file(self.master_range)
+            self._master_range = mn_range.RangeAllocator(self.master_range, reserve=options.master_range_reserve)
+            _master_range = self._master_range.range()
             assert _master_range and 0<=_master_range[0]<_master_range[1]
 
         if known_instances and self.server and self.port:
@@ -70,17 +176,84 @@ class mn_instance():
                 if _server == self.server and _port not in self._instances and _port!=self.port:
                     self._instances.append(_port)
 
-        for _server in self._servers:
-            self.hello(server = _server)
-        for _port in self._instances:
-            self.hello(port = _port)
+        self._ring_servers = self._ring_ports = None
+        if options.ring_enabled:
+            self._ring_servers = mn_ring.HashRing(options.ring_vnodes, [self.server] + self._servers)
+            self._ring_ports = mn_ring.HashRing(options.ring_vnodes, [self.port] + self._instances)
+            self._handover = RingHandover(self)
+
+        if options.digest_period:
+            PeriodicCallback(self._publish_digest, options.digest_period*1000).start()
+        PeriodicCallback(lambda: self._health.check(self._servers + self._instances), 1000).start()
 
-        _range = self._range_from_file(self.range_file, create_if_no=True)
-        if not _range or not (0<_range[0]<=_range[1]):
-            self._range_requests = [self._servers[:], self._instances[:]]
-            self._get_range(self.master_server, self.master_port, self._response_got_range, self.range_size)
+        if self._log:
+            self._load_log()
+            self._log.open()
+            PeriodicCallback(self._flush_log, 1000).start()
 
-    def hello(self, server = None, port = None, instance_headers = None):
+        stats_mon.add_gauge('Range_Remaining', self._range.remaining)
+        stats_mon.add_gauge('Bootstrap_Time', self.bootstrap_time)
+        IOLoop.instance().add_timeout(self._bootstrap_started + options.timeout_bootstrap, self._bootstrap_expired)
+        self._refill_range()
+
+        for _server in self._servers:
+            self._discover(server = _server)
+        for _port in self._instances:
+            self._discover(port = _port)
+        self._check_hellos()
+
+    def _discover(self, server = None, port = None):
+        #   Queues 'hello' to the server/instance: bootstrap_concurrency of them are awaited at once
+        self._hello_queue.append({'server':server} if server else {'port':port})
+        self._discover_next()
+
+    def _discover_next(self):
+        while self._hello_queue and self._hello_awaiting < options.bootstrap_concurrency:
+            self._hello_awaiting +=1
+            self.hello(callback=self._response_hello, **self._hello_queue.pop(0))
+
+    def _check_hellos(self):
+        #   All the known servers/instances answered 'hello': the directory is pulled from one of them
+        if self._hello_awaiting or self._hello_queue or self._initialized:
+            return
+        self._initialized = True
+        access_log.debug('hello done in %.2fs: %i servers, %i instances' %
+                         (time() - self._bootstrap_started, len(self._servers), len(self._instances)))
+        self._refill_range()
+        if options.snapshot_enabled:
+            SnapshotLoader(self, callback=self._directory_loaded).start()
+        else:
+            self._directory_loaded()
+
+    def _directory_loaded(self):
+        self._directory_ready = True
+        self._check_ready()
+
+    def _check_ready(self):
+        #   The instance is ready once it has the directory and CustomerIDs to issue
+        if self.ready or not (self._directory_ready and self._range.remaining() > 0):
+            return
+        self._set_ready()
+
+    def _set_ready(self):
+        self._bootstrap_time = self.bootstrap_time()
+        self.ready = True
+        app_log.info('instance is ready in %.2fs' % (self._bootstrap_time/1000.))
+
+    def bootstrap_time(self):
+        #   ms the instance took to get ready (so far if it's not ready)
+        if self.ready:
+            return self._bootstrap_time
+        return int((time() - self._bootstrap_started)*1000)
+
+    def _bootstrap_expired(self):
+        if self.ready:
+            return
+        app_log.warning('instance is not ready in %is (hello done: %s, directory: %s, IDs left: %i), serving anyway' %
+                        (options.timeout_bootstrap, self._initialized, self._directory_ready, self._range.remaining()))
+        self._set_ready()
+
+    def hello(self, server = None, port = None, instance_headers = None, callback = None):
         #   Says 'hello' to other instances/servers
         url, _headers = self._url('hello', server, port)
         access_log.debug("hello: %s" % url)
@@ -90,8 +263,7 @@ class mn_instance():
             _headers.update(instance_headers)
         request=tornado.httpclient.HTTPRequest(url, body='', method="POST", use_gzip=False, headers=_headers)
         http_client = tornado.httpclient.AsyncHTTPClient()
-        self._hello_awaiting +=1
-        http_client.fetch(request, self._response_hello)
+        http_client.fetch(request, callback or self._response_connected)
 
     def connected(self, CustomerID, server=None, port=None, instance_headers = None):
         #   Notifies others Desktop is connected
@@ -106,10 +278,21 @@ class mn_instance():
         http_client = tornado.httpclient.AsyncHTTPClient()
         http_client.fetch(request, self._response_connected)
 
-    def _find(self, CustomerID, server=None, port=None, callback=None):
+    def digest(self, body, server=None, port=None, instance_headers=None):
+        #   Sends the digest of Desktops connected to the instance
+        url, _headers = self._url('digest', server, port)
+        _headers.update(instance_headers)
+        request=tornado.httpclient.HTTPRequest(url, body=body, method="POST", use_gzip=False, headers=_headers)
+        http_client = tornado.httpclient.AsyncHTTPClient()
+        # the digest upload time is not RTT
+        http_client.fetch(request, partial(self._response_connected, rtt=False))
+
+    def _find(self, CustomerID, server=None, port=None, callback=None, timeout=None):
         url,_headers = self._url('find',server, port)
         _headers.update({MN_PRODUCT_ID: CustomerID})
-        request=tornado.httpclient.HTTPRequest(url, body='', method="POST", use_gzip=False, headers=_headers)
+        _timeout = {'request_timeout':timeout} if timeout else {}
+        request=tornado.httpclient.HTTPRequest(url, body='', method="POST", use_gzip=False, headers=_headers,
+                                               **_timeout)
         http_client = tornado.httpclient.AsyncHTTPClient()
         http_client.fetch(request, callback)
 
@@ -123,88 +306,99 @@ class mn_instance():
         http_client.fetch(request, callback)
 
     def _range_from_range(self, auto=True, num=None, fraction=0.1):
-        _range = None
+        #   Takes num IDs (or the fraction of the rest) from the master range (if auto) or the instance range
         if auto and self.master:
-            _file = self.master_range
+            _allocator = self._master_range
         else:
-            _file = self.range_file
+            _allocator = self._range
 
-        _from, _to = self._range_from_file(_file)
-
-        if num and _to - _from - int(num) + 2:
+        if num:
             _num = int(num)
-        elif fraction<1:
-            _num = int((_to-_from+1)*fraction)
-        else:
-            _num = 0
-        if _num:
-            _range = (str(_from),str(_from + _num -1))
-            if _to -_from -_num + 1:
-                self._range_to_file(_file, (str(_from + _num),str(_to)))
-            else:
-                self._range_to_file(_file, (str(0),str(0)))
-        else:
-            self._range_fd.close()
-        self._range_fd = None
-        if (_num == 0 or _to-_from-_num+1 == 0) and not (auto and self.master):
-            self._need_range = True
-
-        return _range
-
-    def _range_from_file(self, range_file, create_if_no=False):
-        res = None
-        fl = range_file
-        sep = range_file.rpartition(os.sep)
-        if sep[2]:
-            path=sep[0]+sep[1]
-        else:
-            path=os.curdir
-
-        if os.access(fl, os.F_OK | os.R_OK| os.W_OK):
-            mode='r'
-        elif not os.access(fl, os.F_OK) and create_if_no and os.access(path, os.W_OK):
-            mode='w'
-            fd = open(fl, mode)
-            fd.close()
         else:
-            raise EnvironmentError, "You don't have enough permissions to create or open file '%s'" % fl
-
-        if os.path.getsize(fl):
-            fd = open(fl, mode)
-            try:
-                res = (int(fd.readline()), int(fd.readline()))
-            except (ValueError,EOFError):
-                raise EnvironmentError, "File '%s' contains incorrect or missing data" % fl
-            finally:
-                fd.close()
-        else:
-            res = (0,0)
-        return res
-
-    def _range_to_file(self, range_file, _range):
-        access_log.debug("range_to_file (range=%s)" % str(_range))
-        fl = range_file
-        if os.access(fl, os.F_OK | os.R_OK | os.W_OK):
-            fd = open(fl, 'w')
-        else:
-            raise EnvironmentError, "File '%s' doesn't exist or you don't have enough permissions" % fl
-        try:
-            fd.write('\n'.join(_range))
-        finally:
-            fd.close()
+            _num = int(_allocator.remaining()*fraction)
+        _range = _allocator.take(_num) if _num else None
+        if _allocator is self._range:
+            self._refill_range()
+
+        return _range and (str(_range[0]), str(_range[1]))
+
+    def _next_id(self):
+        #   CustomerID for registration, None if the range is over
+        _ID = self._range.next()
+        self._refill_range()
+        return _ID
+
+    def _refill_range(self):
+        #   Requests the next (standby) range in background when the range is low
+        if self._range_requests is not None or not self._range.low():
+            return
+        self._range_requests = [self._live_servers(), self._live_instances()]
+        self._get_range(self.master_server, self.master_port, self._response_got_range,
+                        self._range.request_size(self.range_size))
 
     def _getLocation(self, CustomerID):
-        if CustomerID in self._IDs:
-            return self._IDs[CustomerID]
-        else:
-            return None
+        if self._shared(CustomerID):
+            _location = self._shm.get(CustomerID)
+            if _location is None:
+                # the server the shared directory can't keep: its location is in the instance memory
+                # (Desktops of the instance are kept there as well)
+                _location = self._IDs.get(CustomerID)
+                if _location is not None and _location[0] == self.server:
+                    return None
+            return _location
+        return self._IDs.get(CustomerID)
 
     def _updateLocation(self, CustomerID, instance=None):
+        #   Returns True if location is shared with the server instances
         if instance:
             _instance=instance
         else:
             _instance=(self.server, self.port)
-        self._IDs.update({CustomerID:_instance})
+        self._misses.discard(CustomerID)
+        if _instance in self._digests:
+            # connected after the digest was sent
+            self._digests[_instance][1].add(CustomerID)
+        if self._shared(CustomerID):
+            # Desktops of the instance are kept in its directory as well (to be handed over by the ring)
+            if _instance == (self.server, self.port):
+                self._setLocation(CustomerID, _instance)
+            try:
+                return self._shm.set(CustomerID, _instance)
+            except (ValueError, EnvironmentError) as e:
+                # the server name doesn't fit or there are SHM_SERVERS_MAX servers already:
+                # the location is kept in the instance memory
+                if _instance[0] not in self._unshared:
+                    self._unshared.add(_instance[0])
+                    app_log.warning('locations of "%s" are kept in the instance memory: %s' % (_instance[0], e))
+                self._shm.discard(CustomerID)
+                if _instance == (self.server, self.port):
+                    return False
+        self._setLocation(CustomerID, _instance)
+        return False
+
+    def _setLocation(self, CustomerID, location):
+        self._IDs.set(CustomerID, location)
+        if self._log:
+            self._log.location(CustomerID, location)
+
+    def _stale(self, CustomerID):
+        #   Location is loaded from the directory log and not confirmed since the start
+        return not self._shared(CustomerID) and self._IDs.stale(CustomerID)
+
+    def _touchLocation(self, CustomerID):
+        #   Desktop is active on the instance: its location doesn't expire,
+        #   the home instance is told about it once per directory TTL slice
+        if self._IDs.get(CustomerID) == (self.server, self.port):
+            _refreshed = self._IDs.touch(CustomerID)
+        else:
+            self._updateLocation(CustomerID)
+            _refreshed = True
+        if _refreshed and self._ring_servers is not None:
+            self._notify_home(CustomerID)
+
+    def _shared(self, CustomerID):
+        #   Location is kept in the server shared directory
+        return self._shm is not None and self._shm.key(CustomerID) is not None
 
     def _isHere(self, CustomerID):
         return self._getLocation(CustomerID) == (self.server, self.port)
@@ -214,38 +408,43 @@ class mn_instance():
         if response.error:
             self._rem_instance(response.request, response.error)
         else:
+            self._clear_failed(response.request, response.request_time)
             _headers = response.headers
             if MN_KNOWN_SERVERS in _headers:
                 for _server in _headers[MN_KNOWN_SERVERS].split(','):
                     if _server and _server not in self._servers and _server!=self.server:
                         self._servers.append(_server)
-                        self.hello(server = _server)
+                        self._ring_update(server = _server)
+                        self._discover(server = _server)
             if MN_KNOWN_PORTS in _headers:
                 for _port in _headers[MN_KNOWN_PORTS].split(','):
                     if _port and _port not in self._instances and _port!=self.port:
                         self._instances.append(_port)
-                        self.hello(port = _port)
+                        self._ring_update(port = _port)
+                        self._discover(port = _port)
+        self._discover_next()
+        self._check_hellos()
 
-        if self._hello_awaiting == 0:
-            self._initialized = True
-
-    def _response_connected(self, response):
+    def _response_connected(self, response, rtt=True):
         if response.error:
             self._rem_instance(response.request, response.error)
         else:
-            self._clear_failed(response.request)
+            self._clear_failed(response.request, response.request_time if rtt else None)
 
     def _response_got_range(self, response):
         if MN_INSTANCE_RANGE_FROM in response.headers and MN_INSTANCE_RANGE_TO in response.headers:
             _got_range = (response.headers[MN_INSTANCE_RANGE_FROM], response.headers[MN_INSTANCE_RANGE_TO])
-            self._range_to_file(self.range_file, _got_range)
-            self._need_range = False
+            self._range.add(*_got_range)
+            self._range_requests = None
+            app_log.info('range %s-%s, %i IDs left, %.2f registrations/s' %
+                         (_got_range[0], _got_range[1], self._range.remaining(), self._range.rate))
+            self._check_ready()
         else:
-            params = {'callback':self._response_got_range}
+            params = {'callback':self._response_got_range, 'num':self._range.request_size(self.range_size)}
             if self._range_requests[0]:
-                params.update({'server':self._range_requests[0].pop()})
+                params.update({'server':self._range_requests[0].pop(0)})
             elif self._range_requests[1]:
-                params.update({'port':self._range_requests[1].pop()})
+                params.update({'port':self._range_requests[1].pop(0)})
             else:
                 self._range_requests = None
                 return
@@ -255,38 +454,202 @@ class mn_instance():
         _added=False
         if server==self.server and port and port not in self._instances and port!=self.port:
             self._instances.append(port)
+            self._ring_update(port = port)
             _added=True
         if server and server!=self.server and server not in self._servers:
             self._servers.append(server)
+            self._ring_update(server = server)
             _added=True
         if _added:
             access_log.debug('add instance: server=%s, port=%s' % (server,port))
+        # the server/instance talks to us: its breaker is closed
+        self._health.alive(port if server==self.server else server)
 
     def _rem_instance(self, request, error=None):
+        #   Request to the server/instance failed: max_instance_failed failures in a row open its breaker
+        _key = self._peer(request)
+        access_log.debug('failed connect to instance "%s" (%s)' % (_key, str(error)))
+        self._health.failure(_key, error)
+
+    def _peer(self, request):
         headers=request.headers
         _server=headers.get(MN_TARGET_SERVER,'')
         _port=headers.get(MN_TARGET_PORT,'')
         assert (_server or _port) and not (_server and _port), \
         'Either server("%s") or port("%s") should be specified' % (_server,_port)
-        _key = _server or _port
-        if _key not in self._failed:
-            self._failed[_key] = 1
+        return _server or _port
+
+    def _proxy_worth(self, request, location):
+        #   Mobile app request is to be proxied to the location:
+        #   it's not proxied already, the body is small and the instance is near (same-server if RTT is unknown)
+        if not options.proxy_enabled or MN_PROXIED in request.headers:
+            return False
+        if int(request.headers.get('Content-Length', 0)) > options.proxy_max_body:
+            return False
+        _peer = location[1] if location[0] == self.server else location[0]
+        if not self._health.available(_peer):
+            return False
+        _rtt = self._health.rtt(_peer)
+        if _rtt is None:
+            return location[0] == self.server
+        return _rtt <= options.proxy_max_rtt
+
+    def _live_servers(self):
+        #   Servers whose breakers are closed, the nearest (by RTT) first
+        return self._health.order(self._servers)
+
+    def _live_instances(self):
+        #   Instances of the server whose breakers are closed, the nearest (by RTT) first
+        return self._health.order(self._instances)
+
+    def _probe(self, peer):
+        #   Health check of the server/instance with open breaker
+        if peer in self._instances:
+            url, _headers = self._url('health', port = peer)
         else:
-            self._failed[_key] += 1
-        access_log.debug('failed connect to instance "%s": %i (%s)' % (_key, self._failed[_key], str(error)))
+            url, _headers = self._url('health', server = peer)
+        _headers.update(self._hello_headers)
+        request=tornado.httpclient.HTTPRequest(url, body='', method="POST", use_gzip=False, headers=_headers,
+                                               request_timeout=options.timeout_find)
+        http_client = tornado.httpclient.AsyncHTTPClient()
+        http_client.fetch(request, self._response_connected)
 
-        if self._failed[_key] > options.max_instance_failed:
-            access_log.debug('remove instance "%s"' % _key)
-            self._servers.remove(_server) if _server else self._instances.remove(_port)
-            del self._failed[_key]
+    def _peer_opened(self, peer):
+        #   Server/instance is skipped: its ProductIDs move to other homes
+        if peer in self._instances:
+            self._ring_update(port = peer, add=False)
+        else:
+            self._ring_update(server = peer, add=False)
 
-    def _clear_failed(self, request):
-        headers=request.headers
-        _server=headers.get(MN_TARGET_SERVER,'')
-        _port=headers.get(MN_TARGET_PORT,'')
-        self._failed[_server or _port] = 0
+    def _peer_closed(self, peer):
+        #   Server/instance is re-admitted
+        if peer in self._instances:
+            self._ring_update(port = peer)
+        else:
+            self._ring_update(server = peer)
+
+    def _home(self, CustomerID):
+        #   Home instance of ProductID: (server, port), port is None for other servers
+        _server = self._ring_servers.get(CustomerID)
+        if _server != self.server:
+            return _server, None
+        return _server, self._ring_ports.get(CustomerID)
+
+    def _home_search(self, CustomerID, local=False):
+        #   Parameters to address the home instance of ProductID,
+        #   None if this instance is the home or shares the directory with it.
+        #   local   - the home of the server instances only
+        if local:
+            _server, _port = self.server, self._ring_ports.get(CustomerID)
+        else:
+            _server, _port = self._home(CustomerID)
+        if _port is None:
+            return {'server':_server}
+        if _port != self.port and not self._shared(CustomerID):
+            return {'port':_port}
+        return None
+
+    def _notify_home(self, CustomerID, instance_headers=None, local=False):
+        #   Tells the home instance where the Desktop is
+        _search = self._home_search(CustomerID, local)
+        if _search:
+            self.connected(CustomerID, instance_headers=instance_headers, **_search)
+
+    def _ring_update(self, server=None, port=None, add=True):
+        #   Adds/removes the ring node, the locations the instance keeps are handed over
+        #   to their new homes later (RingHandover)
+        if self._ring_servers is None:
+            return
+        _ring, _node = (self._ring_servers, server) if server else (self._ring_ports, port)
+        if add:
+            _changed = _ring.add(_node)
+        else:
+            _changed = _ring.remove(_node)
+        if _changed:
+            access_log.debug('ring %s "%s"' % ('add' if add else 'remove', _node))
+            self._handover.changed()
+
+    def _load_log(self):
+        #   Restores the directory (stale locations) and Desktops present at the instance
+        _started = time()
+        _present = []
+        for _ProductID, _location in self._log.load():
+            if _location:
+                self._IDs.load(_ProductID, _location)
+            else:
+                _present.append(_ProductID)
+        for _ProductID in _present:
+            mynotes.add_cache(_ProductID)
+        app_log.info('directory log "%s": %i locations, %i Desktops present in %.2fs' %
+                     (self._log.filename, len(self._IDs), len(_present), time() - _started))
+
+    def _flush_log(self):
+        self._log.flush()
+        if self._log.need_compaction(len(self._IDs)):
+            self._log.compact(self._IDs.items(), self._present())
+
+    def _present(self):
+        return list(set(mynotes.awaiting) | set(mynotes.awaiting_cache))
+
+    def close(self):
+        #   Saves the directory log before the instance stops
+        if self._log:
+            self._log.compact(self._IDs.items(), self._present(), sync=True)
+            self._log.close()
+
+    def _snapshot(self, local=False):
+        #   (ProductID, location) of the directory,
+        #   the server shared directory is not sent to the instances of the server (local)
+        if self._shm is None or local:
+            return self._IDs.items()
+        return chain(self._IDs.items(), self._shm.items())
+
+    def _publish_digest(self):
+        #   Sends Bloom filter of the instance Desktops to all the servers and instances
+        _digest = mn_directory.BloomFilter(options.digest_bits)
+        _digest.update(self._IDs.located((self.server, self.port)))
+        _body = zlib.compress(_digest.tostring())
+        _headers = dict(self._hello_headers)
+        _headers[MN_KNOWN_PORTS] = ','.join([self.port] + self._instances)
+        for _server in self._live_servers():
+            self.digest(_body, server=_server, instance_headers=_headers)
+        for _port in self._live_instances():
+            self.digest(_body, port=_port, instance_headers=_headers)
+
+    def _set_digest(self, server, port, ports, body):
+        self._digests[(server, port)] = (time(), mn_directory.BloomFilter(data=zlib.decompress(body)), ports)
+
+    def _digest_lookup(self, CustomerID, server=None, port=None):
+        #   Returns False if the Desktop is not connected to the server/instance for sure,
+        #   True if it may be, None if there are no fresh digests of all the server instances
+        _fresh = time() - MN_DIGEST_FRESH*options.digest_period
+        if port:
+            _keys = [(self.server, port)]
+        else:
+            _ports = set()
+            for (_server, _port), (_received, _digest, _known) in self._digests.items():
+                if _server == server and _received > _fresh:
+                    _ports.add(_port)
+                    _ports.update(_known)
+            _keys = [(server, _port) for _port in _ports]
+        if not _keys:
+            return None
+        for _key in _keys:
+            _digest = self._digests.get(_key)
+            if _digest is None or _digest[0] <= _fresh:
+                return None
+        for _key in _keys:
+            if CustomerID in self._digests[_key][1]:
+                return True
+        return False
+
+    def _clear_failed(self, request, rtt=None):
+        self._health.success(self._peer(request), rtt)
 
     def _url(self, path, server = None, port = None):
+        if options.unix_socket and port and (not server or server==self.server):
+            # same-server instance is reached through its unix socket
+            return self._url_localhost(path, server, port)
         headers={}
         if not server:
             _server = self.server
@@ -305,12 +668,13 @@ class mn_instance():
         return url, headers
 
     def _url_localhost(self, path, server = None, port = None):
-        #   _url() not-tested-yet version
-        #   refers to instances through the localhost instead their DNS names
+        #   _url() version for the same-server instances:
+        #   refers to instances through the localhost instead their DNS names,
+        #   UnixResolver turns 'localhost:<port>' into the instance unix socket (if any)
         headers={}
         if port and (not server or server==self.server):
             # via localhost if refers to 'its' instance
-            url = 'http://localhost:%s/%s' % (str(port),path)
+            url = 'http://%s:%s/%s/%s' % (MN_LOCALHOST, str(port), path, str(port))
             headers[MN_TARGET_PORT] = port
             return url, headers
 
@@ -361,40 +725,100 @@ class MN_Instance_Handler(RequestHandler):
         self.add_header(MN_RESPONSE_TYPE, MN_NO_AGENT)
         self.finish()
 
+    def _read_body(self, callback, _chunks=None, _data=None):
+        #   Reads the request body (HTTPConnection_mn doesn't), callback(body)
+        if _chunks is None:
+            _chunks = []
+            self._body_remaining = int(self.request.headers.get('Content-Length', 0))
+        if _data:
+            _chunks.append(_data)
+            self._body_remaining -= len(_data)
+        if self._body_remaining <= 0:
+            callback(''.join(_chunks))
+            return
+        self.request.connection.stream.read_bytes(min(self._body_remaining, MN_BODY_CHUNK),
+                                                  partial(self._read_body, callback, _chunks))
+
     def _find_desktop(self, response = None):
         _inst = self._instance
         _found_instance = None
 
         if response:
+            if response.error:
+                _inst._rem_instance(response.request, response.error)
+            else:
+                _inst._clear_failed(response.request, response.request_time)
             if MN_INSTANCE_SERVER in response.headers and MN_INSTANCE_PORT in response.headers:
                 _found_instance = (response.headers[MN_INSTANCE_SERVER], response.headers[MN_INSTANCE_PORT])
         else:
+            self._find_started = time()
             _found_instance = _inst._getLocation(self.ProductID)
+            if _found_instance and _found_instance != (_inst.server, _inst.port) and _inst._stale(self.ProductID):
+                # location of the last run: asks whether the Desktop is still there
+                if _found_instance[0] == _inst.server:
+                    _search = {'port':_found_instance[1]}
+                else:
+                    _search = {'server':_found_instance[0]}
+                if options.stats_enabled:
+                    stats_mon._count('Find_Stale')
+                _inst._find(self.ProductID, callback=self._find_desktop, timeout=options.timeout_find, **_search)
+                return
 
         if _found_instance:
-            _inst._updateLocation(self.ProductID, _found_instance)
-            self.set_header(MN_INSTANCE_SERVER, _found_instance[0])
-            self.set_header(MN_INSTANCE_PORT, _found_instance[1])
-            self.finish()
+            self._desktop_found(_found_instance)
+        elif response is None and self.ProductID in _inst._misses:
+            # the last search failed a moment ago
+            self._desktop_found(None, cached=True)
         else:
             self._search_count -=1
             _search = None
 
-            if self._search_count==1:
-                if _inst._instances:
-                    _search={'port':_inst._instances[0]}
+            if _inst._ring_servers is not None:
+                # the only directed query: ask the home instance
+                if self._search_count==1:
+                    _search=_inst._home_search(self.ProductID)
+                self._search_count = 0
+            elif options.find_parallel:
+                # the only step: ask everybody at once
+                if self._search_count==1:
+                    self._search_count = 0
+                    if DesktopFinder(_inst, self.ProductID, self._desktop_found).start():
+                        return
+            elif self._search_count==1:
+                _instances = _inst._live_instances()
+                if _instances and not _inst._shared(self.ProductID):
+                    _search={'port':_instances[0]}
                 else:
                     self._search_count -=1
 
-            if self._search_count==0:
-                if _inst._servers:
-                    _search={'server':_inst._servers[0]}
+            elif self._search_count==0:
+                _servers = _inst._live_servers()
+                if _servers:
+                    _search={'server':_servers[0]}
 
             if _search:
                 _search.update({'CustomerID':self.ProductID, 'callback':self._find_desktop})
                 _inst._find(**_search)
             else:
-                self._not_found_callback()
+                self._desktop_found(None)
+
+    def _desktop_found(self, location, cached=False):
+        if options.stats_enabled:
+            stats_mon._count('Find_Hit' if location else 'Find_Miss_Cached' if cached else 'Find_Miss')
+            stats_mon._time('Find_Time', (time() - self._find_started)*1000)
+        if location:
+            self._instance._updateLocation(self.ProductID, location)
+            self._redirect(location)
+        else:
+            if not cached:
+                self._instance._misses.add(self.ProductID)
+            self._not_found_callback()
+
+    def _redirect(self, location):
+        #   Refers the Mobile app to the instance its Desktop is connected to
+        self.set_header(MN_INSTANCE_SERVER, location[0])
+        self.set_header(MN_INSTANCE_PORT, location[1])
+        self.finish()
 
     def _range_response(self, response=None):
         _inst = self._instance
@@ -404,10 +828,6 @@ class MN_Instance_Handler(RequestHandler):
                 _got_range = (response.headers[MN_INSTANCE_RANGE_FROM], response.headers[MN_INSTANCE_RANGE_TO])
             else:
                 _got_range = _inst._range_from_range()
-                if _inst._need_range:
-                    _inst._range_requests = [_inst._servers[:], _inst._instances[:]]
-                    _inst._get_range(_inst.master_server, _inst.master_port,
-                        _inst._response_got_range, _inst.range_size)
         else:
             _got_range = _inst._range_from_range(num=self.request.headers.get(MN_INSTANCE_RANGE_SIZE, None))
 
@@ -418,6 +838,342 @@ class MN_Instance_Handler(RequestHandler):
         self.finish()
 
 
+class DesktopFinder:
+    #   Scatter-gather Desktop search:
+    #   asks the instances of the server and all the servers at once, the first found location wins.
+    #   Other answers are ignored: AsyncHTTPClient can't abort a fetch,
+    #   so every query is limited by timeout_find as well as the whole search.
+    #   Servers/instances whose digests don't contain the ProductID are not asked.
+    def __init__(self, instance, CustomerID, callback):
+        self._instance = instance
+        self.CustomerID = CustomerID
+        self._callback = callback
+        self._pending = 0
+        self._timeout = None
+
+    def start(self):
+        #   Returns False if there is nobody to ask
+        _inst = self._instance
+        _search = [{'server':_server} for _server in _inst._live_servers()]
+        if not _inst._shared(self.CustomerID):
+            _search.extend({'port':_port} for _port in _inst._live_instances())
+        _digested = [_inst._digest_lookup(self.CustomerID, **_params) for _params in _search]
+        _skipped = _digested.count(False)
+        if options.stats_enabled and _skipped:
+            stats_mon._count('Digest_Skipped', _skipped)
+        _search = [(_params, _digest) for _params, _digest in zip(_search, _digested) if _digest is not False]
+        if not _search:
+            return False
+        self._pending = len(_search)
+        self._timeout = IOLoop.instance().add_timeout(time() + options.timeout_find, self._expired)
+        for _params, _digest in _search:
+            _inst._find(self.CustomerID, callback=partial(self._response, _digest),
+                        timeout=options.timeout_find, **_params)
+        if options.stats_enabled:
+            stats_mon._count('Find_Queries', len(_search))
+            stats_mon._count('Digest_Passed', _digested.count(True))
+        return True
+
+    def _response(self, digested, response):
+        _found = not response.error and \
+            MN_INSTANCE_SERVER in response.headers and MN_INSTANCE_PORT in response.headers
+        if response.error:
+            self._instance._rem_instance(response.request, response.error)
+        else:
+            self._instance._clear_failed(response.request, response.request_time)
+        if options.stats_enabled and digested and not _found and not response.error:
+            stats_mon._count('Digest_False_Positive')
+        if self._callback is None:
+            return
+        self._pending -= 1
+        if _found:
+            self._done((response.headers[MN_INSTANCE_SERVER], response.headers[MN_INSTANCE_PORT]))
+        elif not self._pending:
+            self._done(None)
+
+    def _expired(self):
+        self._timeout = None
+        if self._callback is not None:
+            access_log.debug('find "%s": %i queries expired' % (self.CustomerID, self._pending))
+            self._done(None)
+
+    def _done(self, location):
+        if self._timeout:
+            IOLoop.instance().remove_timeout(self._timeout)
+            self._timeout = None
+        callback, self._callback = self._callback, None
+        callback(location)
+
+
+class ClientProxy:
+    #   Passes the Mobile app request to the instance its Desktop is connected to and relays the reply,
+    #   so the app doesn't reconnect there. The body is read first (it's small), the reply is streamed.
+    #   Other servers are asked through the curl client (if any) keeping connections alive,
+    #   same-server instances through the unix socket.
+    #   The app is referred to the instance as before if the request fails before the reply.
+    def __init__(self, handler, location):
+        self._handler = handler
+        self._location = location
+        self._status = None
+        self._headers = None
+        self._started = None
+
+    def start(self):
+        self._started = time()
+        self._handler._read_body(self._send)
+
+    def _send(self, body):
+        _inst = self._handler._instance
+        _request = self._handler.request
+        if self._location[0] == _inst.server:
+            url, _headers = _inst._url('client', port = self._location[1])
+            _client = tornado.httpclient.AsyncHTTPClient()
+        else:
+            url, _headers = _inst._url('client', server = self._location[0], port = self._location[1])
+            _client = (CurlAsyncHTTPClient or tornado.httpclient.AsyncHTTPClient)()
+        for _name, _value in _request.headers.get_all():
+            if _name not in ('Host', 'Connection', 'Content-Length', 'Transfer-Encoding', 'Expect'):
+                _headers.setdefault(_name, _value)
+        _headers[MN_PROXIED] = '1'
+        access_log.debug('proxy %s -> %s (%i)' % (_request.uri, url, len(body)))
+        request=tornado.httpclient.HTTPRequest(url, body=body, method="POST", use_gzip=False, headers=_headers,
+                                               request_timeout=options.timeout_proxy,
+                                               header_callback=self._header_line, streaming_callback=self._chunk)
+        _client.fetch(request, self._done)
+
+    def _header_line(self, line):
+        if self._headers is None:
+            self._status = line
+            self._headers = []
+        elif line.strip():
+            self._headers.append(line)
+        elif self._status.split(None, 2)[1] == '100':
+            self._headers = None
+        else:
+            self._start_reply()
+
+    def _start_reply(self):
+        _handler = self._handler
+        _version, _code, _reason = (self._status.strip().split(None, 2) + [''])[:3]
+        _headers = HTTPHeaders.parse(''.join(self._headers))
+        for _name in ('Connection', 'Transfer-Encoding', 'Keep-Alive'):
+            if _name in _headers:
+                del _headers[_name]
+        if 'Content-Length' not in _headers:
+            _handler.request.connection.no_keep_alive = True
+        _handler.set_status(int(_code), _reason or None)
+        _handler._headers = _headers
+        self._status = True
+
+    def _chunk(self, data):
+        if self._handler._closed():
+            return
+        self._handler.write(data)
+        self._handler.flush()
+
+    def _done(self, response):
+        _handler = self._handler
+        _inst = _handler._instance
+        if options.stats_enabled:
+            stats_mon._count('Proxy_Requests')
+            stats_mon._time('Proxy_Time', (time() - self._started)*1000)
+        if self._status is not True:
+            # no reply: the app goes there itself
+            app_log.warning('proxy to %s:%s failed: %s' % (self._location[0], self._location[1], response.error))
+            if response.error:
+                _inst._rem_instance(response.request, response.error)
+            if options.stats_enabled:
+                stats_mon._count('Proxy_Failed')
+            if not _handler._closed():
+                MN_Instance_Handler._redirect(_handler, self._location)
+        elif not _handler._closed():
+            _handler.finish()
+
+
+class SnapshotLoader:
+    #   Pulls the directory of an instance of the server (or another server if there are none) after 'hello'.
+    #   The snapshot is streamed and applied chunk by chunk, 'connected' notifications are received meanwhile:
+    #   locations already known are newer than the snapshot ones and are not overwritten.
+    def __init__(self, instance, callback=None):
+        self._instance = instance
+        self._callback = callback
+        self._sources = [{'port':_port} for _port in instance._live_instances()] + \
+                        [{'server':_server} for _server in instance._live_servers()]
+        self._started = time()
+
+    def start(self):
+        #   Asks the next source, returns False if there are no more
+        if not self._sources:
+            if self._callback:
+                self._callback()
+            return False
+        self._source = self._sources.pop(0)
+        self._decompress = zlib.decompressobj()
+        self._tail = ''
+        self._count = self._applied = 0
+        url, _headers = self._instance._url('snapshot', **self._source)
+        _headers.update(self._instance._hello_headers)
+        request = tornado.httpclient.HTTPRequest(url, body='', method="POST", use_gzip=False, headers=_headers,
+                                                 streaming_callback=self._chunk,
+                                                 request_timeout=options.timeout_snapshot)
+        http_client = tornado.httpclient.AsyncHTTPClient()
+        http_client.fetch(request, self._done)
+        return True
+
+    def _chunk(self, data):
+        _inst = self._instance
+        _lines = (self._tail + self._decompress.decompress(data)).split('\n')
+        self._tail = _lines.pop()
+        for _line in _lines:
+            _ProductID, _server, _port = _line.split(' ')
+            self._count += 1
+            if _inst._getLocation(_ProductID) is None:
+                _inst._updateLocation(_ProductID, (_server, _port))
+                self._applied += 1
+
+    def _done(self, response):
+        _source = self._source.get('port') or self._source.get('server')
+        if response.error:
+            app_log.warning('snapshot from "%s" failed: %s' % (_source, response.error))
+            self.start()
+            return
+        _time = time() - self._started
+        app_log.info('snapshot from "%s": %i locations (%i new) in %.2fs' % (_source, self._count, self._applied, _time))
+        if options.stats_enabled:
+            stats_mon._count('Snapshot_Entries', self._applied)
+            stats_mon._time('Snapshot_Time', _time*1000)
+        if self._callback:
+            self._callback()
+
+
+class RingHandover:
+    #   Hands the locations the instance keeps (Desktops connected to it and the ones it's home for,
+    #   of this server and the others) over to their new homes when the ring changes.
+    #   Changes are gathered for MN_HANDOVER_DELAY: a breaker opened and closed meanwhile moves nothing.
+    #   The locations are checked batch by batch across IOLoop iterations, the ones whose home differs
+    #   from the one of the last handover are sent, 'connected' notifications are paced.
+    #   The server shared directory is handed over by the home instance of the ProductID.
+    #   A change during the handover starts the next one when it's done.
+    def __init__(self, instance):
+        self._instance = instance
+        self._handed = self._rings()    # rings the locations are handed over for
+        self._from = None
+        self._entries = None            # locations being checked
+        self._timeout = None
+        self._changed = False
+        self._moved = 0
+
+    def changed(self):
+        if self._entries is not None:
+            self._changed = True
+        elif self._timeout is None:
+            self._timeout = IOLoop.instance().add_timeout(time() + MN_HANDOVER_DELAY, self._start)
+
+    def _rings(self):
+        _inst = self._instance
+        return (mn_ring.HashRing(options.ring_vnodes, _inst._ring_servers.nodes()),
+                mn_ring.HashRing(options.ring_vnodes, _inst._ring_ports.nodes()))
+
+    def _start(self):
+        self._timeout = None
+        _inst = self._instance
+        _servers, _ports = self._handed
+        _servers_changed = set(_servers.nodes()) != set(_inst._ring_servers.nodes())
+        if not _servers_changed and set(_ports.nodes()) == set(_inst._ring_ports.nodes()):
+            return
+        self._from, self._handed = self._handed, self._rings()
+        self._entries = _inst._IDs.items()
+        if _servers_changed and _inst._shm is not None:
+            self._entries = chain(self._entries, self._shared())
+        self._moved = 0
+        self._started = time()
+        self._step()
+
+    def _shared(self):
+        #   Locations of the server shared directory the instance is home for,
+        #   None after every MN_HANDOVER_BATCH slots (the step ends there)
+        _inst = self._instance
+        _ports = self._handed[1]
+        for _start in xrange(0, _inst._shm.size, MN_HANDOVER_BATCH):
+            for _entry in _inst._shm.items(_start, _start + MN_HANDOVER_BATCH):
+                if _ports.get(_entry[0]) == _inst.port:
+                    yield _entry
+            yield None
+
+    def _home(self, rings, CustomerID):
+        _server = rings[0].get(CustomerID)
+        return _server, rings[1].get(CustomerID) if _server == self._instance.server else None
+
+    def _step(self):
+        _inst = self._instance
+        _here = (_inst.server, _inst.port)
+        _checked = _sent = 0
+        for _entry in self._entries:
+            if _entry is None:
+                break
+            CustomerID, _location = _entry
+            _checked += 1
+            if self._home(self._from, CustomerID) != self._home(self._handed, CustomerID):
+                if _location == _here:
+                    _inst._notify_home(CustomerID)
+                else:
+                    _inst._notify_home(CustomerID, instance_headers = {MN_INSTANCE_SERVER:_location[0],
+                                                                       MN_INSTANCE_PORT:_location[1]})
+                _sent += 1
+            if _sent == MN_HANDOVER_NOTIFY or _checked == MN_HANDOVER_BATCH:
+                break
+        else:
+            self._done(_sent)
+            return
+        self._moved += _sent
+        if _sent == MN_HANDOVER_NOTIFY:
+            IOLoop.instance().add_timeout(time() + MN_HANDOVER_PERIOD, self._step)
+        else:
+            IOLoop.instance().add_callback(self._step)
+
+    def _done(self, sent):
+        self._moved += sent
+        self._entries = self._from = None
+        app_log.info('ring handover: %i locations moved in %.2fs' % (self._moved, time() - self._started))
+        if self._changed:
+            self._changed = False
+            self.changed()
+
+
+class inst_Snapshot(MN_Instance_Handler):
+    #   Streams the directory to a (re)started instance:
+    #   zlib-compressed lines 'ProductID server port', every batch is flushed
+    @tornado.web.asynchronous
+    def post (self):
+        _inst = self._instance
+        self._entries = _inst._snapshot(local = self.mn_server == _inst.server)
+        self._compress = zlib.compressobj(1)
+        self._write_batch()
+
+    def _write_batch(self):
+        _lines = ['%s %s %s\n' % (_ProductID, _location[0], _location[1])
+                  for _ProductID, _location in islice(self._entries, MN_SNAPSHOT_BATCH)]
+        if _lines:
+            self.write(self._compress.compress(''.join(_lines)) + self._compress.flush(zlib.Z_SYNC_FLUSH))
+            self.flush(callback = self._write_batch)
+        else:
+            self.finish(self._compress.flush())
+
+
+class inst_Health(MN_Instance_Handler):
+    #   POST: probe of the breaker opened by another server/instance,
+    #   GET: breakers of the instance (admin)
+    @tornado.web.asynchronous
+    def post (self):
+        self._instance._add_instance(self.mn_server, self.mn_port)
+        self.finish()
+
+    def get (self):
+        _inst = self._instance
+        self.write({'server': _inst.server, 'port': _inst.port, 'ready': _inst.ready,
+                    'bootstrap_time': _inst.bootstrap_time(), 'peers': _inst._health.info()})
+
+
 class inst_Hello (MN_Instance_Handler):
     #   'Hello' handler addressed to the server:
     #   port not specified, passed to round-robin instance
@@ -425,7 +1181,7 @@ class inst_Hello (MN_Instance_Handler):
     def post (self):
         _inst = self._instance
         _headers = {MN_INSTANCE_SERVER:self.mn_server,MN_INSTANCE_PORT:self.mn_port}
-        for _port in _inst._instances:
+        for _port in _inst._live_instances():
             _inst.hello(port = _port, instance_headers=_headers)
         self.set_header(MN_KNOWN_SERVERS, ','.join(self._instance._servers))
         _inst._add_instance(self.mn_server, self.mn_port)
@@ -449,13 +1205,17 @@ class agent_Connect (MN_Instance_Handler):
     @tornado.web.asynchronous
     def post (self):
         _inst = self._instance
-        _inst._updateLocation(self.ProductID)
+        _shared = _inst._updateLocation(self.ProductID)
         self.set_header(MN_INSTANCE_PORT, _inst.port)
 
-        for _server in _inst._servers:
-            _inst.connected(self.ProductID, server = _server)
-        for _port in _inst._instances:
-            _inst.connected(self.ProductID, port = _port)
+        if _inst._ring_servers is not None:
+            _inst._notify_home(self.ProductID)
+        else:
+            for _server in _inst._live_servers():
+                _inst.connected(self.ProductID, server = _server)
+            if not _shared:
+                for _port in _inst._live_instances():
+                    _inst.connected(self.ProductID, port = _port)
         self.finish()
 
 
@@ -465,11 +1225,14 @@ class inst_Connected(MN_Instance_Handler):
     @tornado.web.asynchronous
     def post (self):
         _inst = self._instance
-        _inst._updateLocation(self.ProductID, (self.mn_server,  self.mn_port))
+        _shared = _inst._updateLocation(self.ProductID, (self.mn_server,  self.mn_port))
         _inst._add_instance(self.mn_server,  self.mn_port)
         _headers = {MN_INSTANCE_SERVER:self.mn_server,MN_INSTANCE_PORT:self.mn_port}
-        for _port in _inst._instances:
-            _inst.connected(self.ProductID, port = _port, instance_headers = _headers)
+        if _inst._ring_servers is not None:
+            _inst._notify_home(self.ProductID, instance_headers = _headers, local = True)
+        elif not _shared:
+            for _port in _inst._live_instances():
+                _inst.connected(self.ProductID, port = _port, instance_headers = _headers)
         self.finish()
 
 
@@ -484,11 +1247,47 @@ class inst_Connected_port(MN_Instance_Handler):
         self.finish()
 
 
+class inst_Digest(MN_Instance_Handler):
+    #   Digest of Desktops connected to another server instance:
+    #   passed to round-robin instance, sent to all the instances of the server
+    @tornado.web.asynchronous
+    def post (self):
+        self._read_body(self._digest)
+
+    def _digest(self, body):
+        _inst = self._instance
+        _ports = filter(None, self.request.headers.get(MN_KNOWN_PORTS, '').split(','))
+        _inst._set_digest(self.mn_server, self.mn_port, _ports, body)
+        _inst._add_instance(self.mn_server,  self.mn_port)
+        if self.request.path == '/digest':
+            _headers = {MN_INSTANCE_SERVER:self.mn_server, MN_INSTANCE_PORT:self.mn_port,
+                        MN_KNOWN_PORTS:','.join(_ports)}
+            for _port in _inst._live_instances():
+                _inst.digest(body, port = _port, instance_headers = _headers)
+        self.finish()
+
+
 class inst_Find(MN_Instance_Handler):
     #   Makes a search where the Desktop is
     @tornado.web.asynchronous
     def post (self):
-        _desktop = self._instance._getLocation(self.ProductID)
+        _inst = self._instance
+        _desktop = _inst._getLocation(self.ProductID)
+        if not _desktop and _inst._ring_servers is not None and self.request.path == '/find':
+            # addressed to the server: asks the home instance of the server
+            _search = _inst._home_search(self.ProductID, local=True)
+            if _search:
+                _inst._find(self.ProductID, callback=self._response_home, **_search)
+                return
+        self._response_found(_desktop)
+
+    def _response_home(self, response):
+        _desktop = None
+        if MN_INSTANCE_SERVER in response.headers and MN_INSTANCE_PORT in response.headers:
+            _desktop = (response.headers[MN_INSTANCE_SERVER], response.headers[MN_INSTANCE_PORT])
+        self._response_found(_desktop)
+
+    def _response_found(self, _desktop):
         if _desktop:
             self.set_header(MN_INSTANCE_SERVER,_desktop[0])
             self.set_header(MN_INSTANCE_PORT,_desktop[1])
@@ -516,7 +1315,7 @@ class inst_Range(MN_Instance_Handler):
                 server= _inst.master_server,
                 port = _inst.master_port,
                 callback = self._range_response,
-                num = _inst.range_size
+                num = self.request.headers.get(MN_INSTANCE_RANGE_SIZE, _inst.range_size)
             )
 
 
@@ -534,16 +1333,8 @@ class agent_getID(MN_Instance_Handler):
     @tornado.web.asynchronous
     def post (self):
         _inst = self._instance
-        _got_range=None
-        if not _inst._need_range:
-            _got_range = _inst._range_from_range(auto=False, num=1, fraction=0)
-
-        if _got_range:
-            self.set_header(MN_PRODUCT_ID, _got_range[0])
-
-        if _inst._need_range:
-            _inst._range_requests = [_inst._servers[:], _inst._instances[:]]
-            _inst._get_range(_inst.master_server, _inst.master_port, _inst._response_got_range, _inst.range_size)
-
+        _ID = _inst._next_id()
+        if _ID is not None:
+            self.set_header(MN_PRODUCT_ID, str(_ID))
         self.finish()
 
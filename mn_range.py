@@ -0,0 +1,191 @@
+""" CustomerID range of the instance:
+IDs are issued from memory, blocks of them are reserved in the range file
+"""
+__author__ = 'morozov'
+import os
+import fcntl
+from time import time
+from tornado.log import access_log
+from tornado.options import define, options
+from mn_stats import stats_mon
+
+# IDs reserved by one range file write: the file is ahead of issued IDs by up to range_reserve
+define('range_reserve', default=100, type=int)
+# the next range is requested when less than range_low_watermark IDs are left
+# (or less than the registrations of RANGE_REFILL_TIME seconds)
+define('range_low_watermark', default=200, type=int)
+# IDs reserved by one master_range file write: the master hands out ranges from memory
+define('master_range_reserve', default=100000, type=int)
+
+RANGE_RATE_ALPHA = 0.2      # EWMA weight of the last second registration rate
+RANGE_REFILL_TIME = 10      # seconds to get the next range
+RANGE_HORIZON = 600         # seconds of registrations the requested range is for
+RANGE_SIZE_MAX = 100        # requested range is range_size .. range_size * RANGE_SIZE_MAX
+
+
+def fsync_directory(filename):
+    #   Makes the rename of the file durable: the directory entry is written out as well
+    _fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(_fd)
+    finally:
+        os.close(_fd)
+
+
+def read_range(range_file, create_if_no=False):
+    #   [(from, to), ...] of the range file: the range and the standby ones, [(0, 0)] if the file is empty
+    sep = range_file.rpartition(os.sep)
+    if sep[2]:
+        path=sep[0]+sep[1]
+    else:
+        path=os.curdir
+
+    if os.access(range_file, os.F_OK | os.R_OK| os.W_OK):
+        pass
+    elif not os.access(range_file, os.F_OK) and create_if_no and os.access(path, os.W_OK):
+        open(range_file, 'w').close()
+    else:
+        raise EnvironmentError, "You don't have enough permissions to create or open file '%s'" % range_file
+
+    if not os.path.getsize(range_file):
+        return [(0, 0)]
+    fd = open(range_file, 'r')
+    try:
+        _values = [int(_line) for _line in fd.read().split()]
+        if not _values or len(_values) % 2:
+            raise ValueError
+        return zip(_values[::2], _values[1::2])
+    except (ValueError,EOFError):
+        raise EnvironmentError, "File '%s' contains incorrect or missing data" % range_file
+    finally:
+        fd.close()
+
+
+def _size(_range):
+    if _range[1] and _range[0] <= _range[1]:
+        return _range[1] - _range[0] + 1
+    return 0
+
+
+class RangeAllocator:
+    #   Range file contains 'from' and 'to' lines of the range (0 and 0 if it's over),
+    #   then the lines of standby ranges (if any) to be used when the range is over.
+    #   An allocator reserves a block of IDs from the file and issues them from memory.
+    #   Block is reserved under fcntl lock of range_file.lock: the file is read, its 'from' is moved
+    #   past the block and the file is rewritten (temporary file, fsync, rename) before the first ID
+    #   of the block is issued. So no ID is issued twice by several processes sharing the file
+    #   (or a maintenance tool) and after a crash (the rest of the block is skipped).
+    #   Registration rate (EWMA, IDs per second) sets the low watermark and the size of the next range.
+    def __init__(self, range_file, reserve=None, create_if_no=False):
+        self.range_file = range_file
+        self.reserve = reserve or options.range_reserve
+        self._ranges = read_range(range_file, create_if_no)
+        self._lock_fd = os.open(range_file + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        self._from, self._to = 0, -1        # reserved block
+        self.writes = 0
+        self.exhausted = 0
+        self.rate = 0.0
+        self._second = self._issued = 0
+
+    def range(self):
+        #   (from, to) of the file range (as read last time)
+        return self._ranges[0]
+
+    def remaining(self):
+        #   IDs left in the block and the file (as read last time) including the standby ranges
+        return self._to - self._from + 1 + sum(_size(_range) for _range in self._ranges)
+
+    def low(self):
+        #   The next range is to be requested: there is no standby range and few IDs left
+        return len(self._ranges) < 2 and \
+            self.remaining() < max(options.range_low_watermark, self.rate * RANGE_REFILL_TIME)
+
+    def request_size(self, range_size):
+        #   Size of the next range: registrations of RANGE_HORIZON seconds
+        return max(range_size, min(int(self.rate * RANGE_HORIZON), range_size * RANGE_SIZE_MAX))
+
+    def next(self):
+        #   Next ID, None if the range is over
+        self._count_rate()
+        if self._from > self._to and not self._reserve(self.reserve):
+            self.exhausted += 1
+            if options.stats_enabled:
+                stats_mon._count('Range_Exhausted')
+            return None
+        _ID = self._from
+        self._from += 1
+        return _ID
+
+    def take(self, num):
+        #   (from, to) of num IDs at most, None if the range is over;
+        #   taken from the block, the file is touched once per `reserve` IDs
+        if self._from > self._to and not self._reserve(max(num, self.reserve)):
+            return None
+        _range = (self._from, min(self._from + num - 1, self._to))
+        self._from = _range[1] + 1
+        return _range
+
+    def add(self, _from, _to):
+        #   New range (got from another instance): the range if it's over, a standby one otherwise
+        self._lock()
+        try:
+            _ranges = read_range(self.range_file)
+            _ranges.append((int(_from), int(_to)))
+            self._write(_ranges)
+        finally:
+            self._unlock()
+
+    def _reserve(self, num):
+        #   Reserves the next block of num IDs at most, returns False if the file range is over
+        self._lock()
+        try:
+            _ranges = read_range(self.range_file)
+            while len(_ranges) > 1 and not _size(_ranges[0]):
+                _ranges.pop(0)
+            _from, _to = _ranges[0]
+            if not _size(_ranges[0]):
+                self._ranges = _ranges
+                return False
+            self._from, self._to = _from, min(_from + num - 1, _to)
+            _ranges[0] = (self._to + 1, _to)
+            self._write(_ranges)
+            return True
+        finally:
+            self._unlock()
+
+    def _count_rate(self):
+        _now = int(time())
+        if _now != self._second:
+            if self._second:
+                self.rate = RANGE_RATE_ALPHA * self._issued / (_now - self._second) + \
+                            (1 - RANGE_RATE_ALPHA) * self.rate
+            self._second, self._issued = _now, 0
+        self._issued += 1
+
+    def _write(self, ranges):
+        #   The ranges which are over are dropped, the range is written as '0 0' if all of them are
+        _ranges = [_range for _range in ranges if _size(_range)] or [(0, 0)]
+        access_log.debug("range_to_file (range=%s)" % str(_ranges))
+        if not os.access(self.range_file, os.F_OK | os.R_OK | os.W_OK):
+            raise EnvironmentError, "File '%s' doesn't exist or you don't have enough permissions" % self.range_file
+        _temp = self.range_file + '.tmp'
+        fd = open(_temp, 'w')
+        try:
+            fd.write('\n'.join('%i\n%i' % _range for _range in _ranges))
+            fd.flush()
+            os.fsync(fd.fileno())
+        finally:
+            fd.close()
+        os.rename(_temp, self.range_file)
+        # the old file (lower high-water mark) doesn't come back after a crash
+        fsync_directory(self.range_file)
+        self._ranges = _ranges
+        self.writes += 1
+        if options.stats_enabled:
+            stats_mon._count('Range_Writes')
+
+    def _lock(self):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
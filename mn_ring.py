@@ -0,0 +1,60 @@
+""" Consistent hashing ring with virtual nodes: ProductID -> its home node (server or port)
+"""
+__author__ = 'morozov'
+from bisect import bisect, insort
+from hashlib import md5
+
+
+def ring_hash(value):
+    return int(md5(value).hexdigest()[:16], 16)
+
+
+class HashRing:
+    #   Every node owns vnodes points of the ring, a key belongs to the node of the next point clockwise.
+    #   Adding or removing a node inserts or deletes its own points only,
+    #   so only the keys of the arcs ending at those points change their node.
+    def __init__(self, vnodes=64, nodes=None):
+        self.vnodes = vnodes
+        self._points = []       # sorted (hash, node)
+        self._nodes = set()
+        for _node in nodes or []:
+            self.add(_node)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def nodes(self):
+        return list(self._nodes)
+
+    def add(self, node):
+        #   Returns False if the node is already in the ring
+        if node in self._nodes:
+            return False
+        self._nodes.add(node)
+        for _point in self._node_points(node):
+            insort(self._points, _point)
+        return True
+
+    def remove(self, node):
+        #   Returns False if there is no such node
+        if node not in self._nodes:
+            return False
+        self._nodes.remove(node)
+        _points = set(self._node_points(node))
+        self._points = [_point for _point in self._points if _point not in _points]
+        return True
+
+    def get(self, key):
+        #   Node the key belongs to (None if the ring is empty)
+        if not self._points:
+            return None
+        _index = bisect(self._points, (ring_hash(key),))
+        if _index == len(self._points):
+            _index = 0
+        return self._points[_index][1]
+
+    def _node_points(self, node):
+        return [(ring_hash('%s#%i' % (node, _i)), node) for _i in xrange(self.vnodes)]
@@ -4,15 +4,22 @@ Module contains RequestHandler classes for Desktop / Mobile App interactions
 __author__ = 'morozov'
 from tornado.ioloop import IOLoop
 from tornado.web import RequestHandler, HTTPError
+from tornado.websocket import WebSocketHandler
+from tornado import stack_context
 from tornado.log import access_log, app_log, gen_log
+import tornado.escape
 import tornado.httputil
+import tornado.netutil
 from tornado.options import define, options
 from tornado.iostream import StreamClosedError
 import sys
 import os
+import signal
 import mn_httpserver as http
 import mynotes as mn
 import mn_instance as instance
+import mn_workers
+from mn_stats import stats_mon
 
 
 class MN_Handler(RequestHandler):
@@ -58,10 +65,10 @@ class MN_Handler(RequestHandler):
 
         if hasattr(self.request, "connection"):
             # Now that the request is finished, clear the callback we
-            # set on the IOStream (which would otherwise prevent the
+            # set on the HTTPConnection (which would otherwise prevent the
             # garbage collection of the RequestHandler when there
             # are keepalive connections)
-            self.request.connection.stream.set_close_callback(None)
+            self.request.connection.set_close_callback(None)
 
         if not self.application._wsgi:
             # enhancement is here:
@@ -74,6 +81,14 @@ class MN_Handler(RequestHandler):
         self._finished = True
         self.on_finish()
 
+    def on_connection_close(self):
+        #   The connection is closed (e.g. by the reaper) while the request data are transferred:
+        #   the other side of the interaction is closed as well
+        _interaction = mn.get_Interaction(self.RequestID)
+        if _interaction and _interaction._source is self and _interaction._remaining > 0:
+            _interaction._completed = False
+            _interaction._close_destination()
+
     def _request_summary(self):
         #   class specific summary
         _h = self.request.headers
@@ -171,6 +186,15 @@ class MN_Handler(RequestHandler):
         self.add_header(mn.MN_RESPONSE_TYPE, mn.MN_NO_AGENT)
         self.finish()
 
+    def _response_not_ready(self):
+        #   The instance is starting: Desktop/Mobile app should repeat the request later
+        if options.stats_enabled:
+            stats_mon._count('Not_Ready')
+        self.set_status(503)
+        self.set_header('Retry-After', 1)
+        self.add_header(mn.MN_RESPONSE_TYPE, mn.MN_NOT_READY)
+        self.finish()
+
     def _response_no_reply(self):
         if self._closed():
             reason = 'Request closed'
@@ -210,6 +234,10 @@ class Agent_ready(MN_Handler):
     #   Desktop is ready to listen Mobile App requests
     @tornado.web.asynchronous
     def post(self):
+        if not self._instance.ready:
+            self._response_not_ready()
+            return
+        self._instance._touchLocation(self.ProductID)
         self.process_agent()
 
     def on_finish(self):
@@ -240,7 +268,7 @@ class Client(MN_Handler, instance.MN_Instance_Handler):
         #   refers to new Desktop location if found;
         _agent = None
         if not repeat:
-            _agent = mn.get_Agent(self.ProductID)
+            _agent = mn.get_Channel(self.ProductID) or mn.get_Agent(self.ProductID)
         if _agent:
             mn.Interaction(self,_agent)(self,_agent)
         elif not self._closed() and self._instance._isHere(self.ProductID) and mn.get_cache(self.ProductID):
@@ -254,14 +282,151 @@ class Client(MN_Handler, instance.MN_Instance_Handler):
 
     @tornado.web.asynchronous
     def post(self):
+        if not self._instance.ready:
+            self._response_not_ready()
+            return
         self.process_client(repeat=False)
 
+    def _redirect(self, location):
+        #   The request is proxied to the instance of the Desktop instead of the referral if it's worth
+        if self._instance._proxy_worth(self.request, location):
+            instance.ClientProxy(self, location).start()
+        else:
+            instance.MN_Instance_Handler._redirect(self, location)
+
     def on_finish(self):
         _interaction = mn.get_Interaction(self.RequestID, remove=True)
         if _interaction:
             _interaction._clear(self.request.request_time()*1000)
 
 
+class Agent_channel(WebSocketHandler):
+    #   Desktop channel (WebSocket): App requests are pushed to the Desktop and its replies come back
+    #   as frames of one connection, many interactions at once (RequestID of the frame tells them apart).
+    #   Desktop without the channel is served by /agent/ + /agentreply/ long polling.
+    #   The channel is pinged every channel_ping seconds and closed if nothing comes from it till the next ping.
+    def __init__(self, application, request, **kwargs):
+        WebSocketHandler.__init__(self, application, request, **kwargs)
+        self.ProductID = request.headers.get(mn.MN_PRODUCT_ID, '')
+        self.replies = {}
+        self._alive = True
+        self._instance = application._instance
+
+    def open(self, *args):
+        if not self.ProductID or not self._instance.ready:
+            self.close()
+            return
+        # the connection deadlines are replaced by the pings
+        http.connection_reaper.remove(self.request.connection)
+        self._instance._touchLocation(self.ProductID)
+        mn.add_channel(self)
+        access_log.info('channel of %s opened', self.ProductID)
+        # Apps waiting for the Desktop
+        _client = mn.get_Client(self.ProductID)
+        while _client:
+            _agent = mn.ChannelRequest(self)
+            with stack_context.ExceptionStackContext(_client._stack_context_handle_exception):
+                mn.Interaction(_client, _agent)(_client, _agent)
+            _client = mn.get_Client(self.ProductID)
+
+    def on_message(self, message):
+        self._alive = True
+        try:
+            _kind, _RequestID, _payload = mn.parse_frame(tornado.escape.utf8(message))
+        except ValueError as e:
+            gen_log.warning('channel of %s: %s', self.ProductID, e)
+            return
+        if _kind == mn.MN_CHANNEL_DATA:
+            _reply = self.replies.get(_RequestID)
+            if _reply:
+                _reply.feed(_payload)
+        elif _kind == mn.MN_CHANNEL_HEADERS:
+            self._reply(_RequestID, tornado.httputil.HTTPHeaders.parse(_payload.tobytes()))
+        elif _kind == mn.MN_CHANNEL_CANCEL:
+            self._cancelled(_RequestID, _payload.tobytes())
+
+    def _reply(self, RequestID, headers):
+        #   Replies: Mobile App <- Desktop (process_reply over the channel)
+        try:
+            _interaction = mn.get_Interaction(RequestID, validateID = self.ProductID)
+        except ValueError as e:
+            self.cancel(RequestID, 502, e)
+            return
+        if _interaction and not _interaction.client._closed() and not _interaction.agent:
+            _reply = self.replies[RequestID] = mn.ChannelReply(self, RequestID, headers)
+            _interaction._set_agent(_reply)
+            with stack_context.ExceptionStackContext(_reply._handle_exception):
+                _interaction(_reply, _interaction.client, source_finish=True)
+        elif _interaction and _interaction.agent:
+            self.cancel(RequestID, 501, 'RequestID is being replied')
+        else:
+            self.cancel(RequestID, 502, 'No client to reply')
+
+    def _cancelled(self, RequestID, reason):
+        #   The Desktop can't reply: App gets the error at once instead of the no reply timeout
+        try:
+            _interaction = mn.get_Interaction(RequestID, validateID = self.ProductID)
+        except ValueError:
+            return
+        if not _interaction or not _interaction.client or _interaction.client._finished:
+            return
+        _interaction._completed = False
+        _reply = self.replies.pop(RequestID, None)
+        if _reply:
+            _interaction._close_destination()
+            return
+        _client = _interaction.client
+        if _client._timeout:
+            IOLoop.instance().remove_timeout(_client._timeout)
+            _client._timeout = None
+        _client.send_error(502, exc_info = (HTTPError, HTTPError(502, reason or 'Cancelled by agent')))
+
+    def send(self, message, callback=None):
+        #   Sends the frame, the callback is run when it's sent (interactions share the stream)
+        if self.ws_connection is None:
+            raise StreamClosedError()
+        self.write_message(message, binary=True)
+        if callback:
+            if hasattr(self.stream, 'on_drained'):
+                self.stream.on_drained(callback)
+            else:
+                IOLoop.instance().add_callback(callback)
+
+    def cancel(self, RequestID, status_code, reason):
+        if self.ws_connection is not None and not self.stream.closed():
+            self.send(mn.channel_frame(mn.MN_CHANNEL_CANCEL, RequestID, '%i %s' % (status_code, reason)))
+
+    def keep_alive(self):
+        if not self._alive:
+            gen_log.info('channel of %s is silent: closed', self.ProductID)
+            self.stream.close()
+            return
+        self._alive = False
+        self.ping(b'')
+        self._instance._touchLocation(self.ProductID)
+
+    def on_pong(self, data):
+        self._alive = True
+
+    def close(self):
+        #   tornado calls on_close() only if the channel is closed by the Desktop
+        _open = self.ws_connection is not None
+        WebSocketHandler.close(self)
+        if _open:
+            self.on_close()
+
+    def on_close(self):
+        mn.remove_channel(self)
+        access_log.info('channel of %s closed', self.ProductID)
+        # the replies being transferred are cut: their Apps are closed
+        for _RequestID in self.replies.keys():
+            _interaction = mn.get_Interaction(_RequestID)
+            if _interaction:
+                _interaction._completed = False
+                _interaction._close_destination()
+        self.replies.clear()
+
+
 class Agent_ping (MN_Handler):
     # just 'ping' to choose the closest server
     @tornado.web.asynchronous
@@ -290,6 +455,12 @@ def _set_max_clients():
 
 tornado.options.add_parse_callback(_set_max_clients)
 
+
+def _shutdown(application):
+    #   SIGTERM: saves the instance state and stops
+    application._instance.close()
+    IOLoop.instance().stop()
+
 if __name__ == "__main__":
     instance_conf = None
     tornado.options.parse_command_line(final=False)
@@ -300,7 +471,32 @@ if __name__ == "__main__":
 
     if instance_conf and os.access(instance_conf, os.F_OK):
         tornado.options.parse_config_file(instance_conf, final=False)
-    tornado.options.parse_command_line()
+    tornado.options.parse_command_line(final=False)
+
+    _unix_socket = instance.unix_socket_path(options.port)
+    _unix_sockets = []
+    if options.workers > 1:
+        if mn_workers.sendfd is None:
+            raise EnvironmentError, "workers need file descriptor passing (_multiprocessing.sendfd)"
+        if options.certfile and options.keyfile and options.port_ssl:
+            # the SSL connection can't be handed over to the worker of its ProductID (its SSL state stays here):
+            # Desktop and Mobile app of the ProductID wouldn't meet
+            raise EnvironmentError, "direct SSL (certfile/keyfile/port_ssl) can't be used with workers > 1"
+        # the unix socket is bound once: instances talk to any of the workers
+        if _unix_socket:
+            _unix_sockets.append(tornado.netutil.bind_unix_socket(_unix_socket))
+        if mn_workers.fork_workers(options.workers) is None:
+            sys.exit(0)
+        # every worker keeps its own files and directory part;
+        # it publishes no digest: it knows the Desktops of its ProductIDs only
+        options.stats_file_prefix = mn_workers.worker_suffix(options.stats_file_prefix)
+        options.rrd_file = mn_workers.worker_suffix(options.rrd_file)
+        options.directory_log = mn_workers.worker_suffix(options.directory_log)
+        options.log_file_prefix = mn_workers.worker_suffix(options.log_file_prefix)
+        options.digest_period = 0
+    elif _unix_socket:
+        _unix_sockets.append(tornado.netutil.bind_unix_socket(_unix_socket))
+    tornado.options.options.run_parse_callbacks()
 
 
     application = http.Application_mn([
@@ -315,8 +511,12 @@ if __name__ == "__main__":
         (r"/connected/.*", instance.inst_Connected_port),
         (r"/range/.*", instance.inst_Range_port),
         (r"/find.*", instance.inst_Find),
+        (r"/digest.*", instance.inst_Digest),
+        (r"/snapshot.*", instance.inst_Snapshot),
+        (r"/health.*", instance.inst_Health),
         (r"/client/.*", Client),
         (r"/agentreply/.*", Agent_reply),
+        (r"/agentws/.*", Agent_channel),
         (r"/agent/.*", Agent_ready)],
         instance=instance.mn_instance(
             options.server, options.port,
@@ -329,7 +529,15 @@ if __name__ == "__main__":
     )
 
     http_server = http.HTTPServer_mn(application)
-    http_server.listen(int(options.port), options.host)
+    if options.workers > 1:
+        http_server.add_sockets(mn_workers.bind_reuseport(int(options.port), options.host))
+        http_server.handoff = mn_workers.Handoff(options.port, http_server)
+    else:
+        http_server.listen(int(options.port), options.host)
+
+    for _socket in _unix_sockets:
+        # same-server instances talk to each other through the unix socket
+        http_server.add_socket(_socket)
 
     if options.certfile and options.keyfile and options.port_ssl:
         ssl_options={
@@ -339,4 +547,6 @@ if __name__ == "__main__":
         https_server = http.HTTPServer_mn(application, ssl_options=ssl_options)
         https_server.listen(options.port_ssl, options.host)
 
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: IOLoop.instance().add_callback_from_signal(_shutdown, application))
     tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
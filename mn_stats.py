@@ -32,6 +32,8 @@ define('rrd_rra', default=[(1,60),(5,72),(6,24)])
 define('rrd_reset', default=False)
 
 stats={}
+counters={}
+gauges={}
 
 class PeriodicCallback_start(PeriodicCallback):
     def start(self, start_timeout=0):
@@ -187,6 +189,42 @@ class stats_monitor:
         stats ['Bytes_Total']+=num
         stats ['Bytes_Period']+=num
 
+    def _count(self, key, num=1):
+        #   Period counter, logged as 'key=value' and reset every period
+        if not self.enabled:
+            return
+        counters[key] = counters.get(key, 0) + num
+
+    def _time(self, key, ms):
+        #   Period average duration, logged as 'key=average'
+        if not self.enabled:
+            return
+        _time = counters.setdefault(key, [0.0, 0])
+        _time[0] += ms
+        _time[1] += 1
+
+    def add_gauge(self, key, get_value):
+        #   Value to be logged as 'key=value' every period, get_value() is called to get it
+        gauges[key] = get_value
+
+    def _run_counters(self):
+        #   Puts period counters and gauges to stats file
+        for key, get_value in gauges.items():
+            counters[key] = get_value()
+        if not counters:
+            return
+        _values = []
+        for key in sorted(counters):
+            value = counters[key]
+            if isinstance(value, list):
+                value = value[0]/value[1] if value[1] else 0
+            if isinstance(value, float):
+                _values.append('%s=%.3f' % (key, value))
+            else:
+                _values.append('%s=%s' % (key, value))
+        self.logger.info(', '.join(_values))
+        counters.clear()
+
     def _run(self):
         # Puts stats data to file / RRD-archive
         for key in ['Agent','Interact']:
@@ -223,6 +261,7 @@ class stats_monitor:
             )
         )
 
+        self._run_counters()
         self._run_rrd()
 
         stats['Bytes_Period']=0
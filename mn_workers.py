@@ -0,0 +1,222 @@
+""" Worker processes of the instance:
+the instance port is shared by the workers (SO_REUSEPORT), every ProductID belongs to one of them;
+a connection accepted by another worker is handed over to the owner (file descriptor passing),
+so Desktop and App of the ProductID meet in the same process
+"""
+__author__ = 'morozov'
+import os
+import errno
+import logging
+import random
+import signal
+import socket
+import struct
+import time
+from zlib import crc32
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.netutil import add_accept_handler, bind_unix_socket
+from tornado.log import app_log, gen_log, enable_pretty_logging
+from tornado.options import define, options
+from mynotes import MN_PRODUCT_ID
+from mn_stats import stats_mon
+try:
+    from _multiprocessing import sendfd, recvfd
+except ImportError:
+    sendfd = recvfd = None
+
+# processes serving the instance port (1 - the instance is one process)
+define('workers', default=1, type=int)
+# unix socket path template the worker gets handed over connections by, %s - the port, %i - the worker
+define('worker_socket', default='run/%s.w%i.sock', type=str)
+
+WORKER_HANDOFF = struct.Struct('!II')   # family of the handed over socket, bytes read from it
+WORKER_RESTART_DELAY = 1                # seconds before the exited worker is started again
+WORKER_HANDOFF_WAIT = 1                 # seconds to wait for the socket of the accepted handoff
+
+worker_id = 0
+
+
+def worker_of(ProductID):
+    #   Worker the ProductID belongs to
+    return (crc32(ProductID) & 0xffffffff) % options.workers
+
+
+def worker_suffix(value):
+    #   Per worker file name (stats, rrd, directory log): 'stats.log' -> 'stats.log.w1'
+    if value and options.workers > 1:
+        return '%s.w%i' % (value, worker_id)
+    return value
+
+
+def fork_workers(num):
+    #   Starts num worker processes: returns the worker id in the worker, None in the parent
+    #   when all the workers are done. The parent starts the worker exited abnormally again
+    #   and passes SIGTERM to the workers.
+    #   (tornado.process.fork_processes without the workers list can't pass the signal)
+    global worker_id
+    _children = {}
+
+    def _start(_id):
+        _pid = os.fork()
+        if _pid == 0:
+            # the worker sets up its own logging
+            del logging.getLogger().handlers[:]
+            random.seed()
+            return _id
+        _children[_pid] = _id
+        return None
+
+    def _terminate(signum, frame):
+        for _pid in _children.keys():
+            try:
+                os.kill(_pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    for _id in range(num):
+        if _start(_id) is not None:
+            worker_id = _id
+            return _id
+    signal.signal(signal.SIGTERM, _terminate)
+    enable_pretty_logging()
+    while _children:
+        try:
+            _pid, _status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        _id = _children.pop(_pid, None)
+        if _id is None:
+            continue
+        if os.WIFSIGNALED(_status):
+            if os.WTERMSIG(_status) == signal.SIGTERM:
+                continue
+            app_log.warning('worker %i (pid %i) killed by signal %i, restarting', _id, _pid, os.WTERMSIG(_status))
+        elif os.WEXITSTATUS(_status):
+            app_log.warning('worker %i (pid %i) exited with status %i, restarting', _id, _pid, os.WEXITSTATUS(_status))
+        else:
+            continue
+        time.sleep(WORKER_RESTART_DELAY)
+        if _start(_id) is not None:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            worker_id = _id
+            return _id
+    return None
+
+
+def bind_reuseport(port, address=None, backlog=128):
+    #   Listening sockets of the port every worker binds by itself: the kernel spreads connections
+    #   among the workers instead of waking them all up on every connection
+    _sockets = []
+    if address == '':
+        address = None
+    for af, socktype, proto, canonname, sockaddr in set(socket.getaddrinfo(
+            address, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)):
+        _sock = socket.socket(af, socktype, proto)
+        _sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        _sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+        if af == socket.AF_INET6 and hasattr(socket, 'IPPROTO_IPV6'):
+            _sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        _sock.setblocking(0)
+        _sock.bind(sockaddr)
+        _sock.listen(backlog)
+        _sockets.append(_sock)
+    return _sockets
+
+
+class Handoff:
+    #   Passes connections of other workers' ProductIDs to them and takes their ones:
+    #   the socket and the data read from it (request headers, read ahead body)
+    #   go through the unix socket of the owner worker.
+    #   If the owner can't take it (e.g. it's restarting), the request is served by the worker accepted it.
+    def __init__(self, port, server):
+        self._port = port
+        self._server = server           # HTTPServer_mn handling the taken connections
+        self._socket = bind_unix_socket(options.worker_socket % (port, worker_id))
+        add_accept_handler(self._socket, self._accept)
+
+    def worker(self, headers):
+        #   Owner worker of the request unless it's this one
+        _ProductID = headers.get(MN_PRODUCT_ID)
+        if not _ProductID:
+            return None
+        _worker = worker_of(_ProductID)
+        if _worker == worker_id:
+            return None
+        return _worker
+
+    def send(self, stream, data, worker):
+        #   Hands the stream over to the worker: True if it's done (the stream is closed here)
+        _data = data + stream.unread()
+        _sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            _sock.connect(options.worker_socket % (self._port, worker))
+            sendfd(_sock.fileno(), stream.socket.fileno())
+        except (socket.error, OSError) as e:
+            _sock.close()
+            gen_log.warning('worker %i: handoff to worker %i failed: %s', worker_id, worker, e)
+            if options.stats_enabled:
+                stats_mon._count('Handoff_Failed')
+            return False
+        _sock.setblocking(0)
+        _relay = IOStream(_sock)
+        _relay.write(WORKER_HANDOFF.pack(stream.socket.family, len(_data)) + _data, _relay.close)
+        stream.close()
+        if options.stats_enabled:
+            stats_mon._count('Handoff')
+        return True
+
+    def _accept(self, connection, address):
+        #   The socket goes first: it's taken when the connection is readable
+        #   (the IOLoop waits for it up to WORKER_HANDOFF_WAIT seconds)
+        _io_loop = IOLoop.instance()
+        connection.setblocking(0)
+
+        def _readable(fd, events):
+            _io_loop.remove_timeout(_timeout)
+            _io_loop.remove_handler(fd)
+            try:
+                _fd = recvfd(fd)
+            except (socket.error, OSError) as e:
+                gen_log.warning('worker %i: handoff receiving failed: %s', worker_id, e)
+                connection.close()
+                return
+            self._on_socket(connection, _fd)
+
+        def _expired():
+            _io_loop.remove_handler(connection.fileno())
+            gen_log.warning('worker %i: handoff receiving failed: no socket', worker_id)
+            connection.close()
+
+        _timeout = _io_loop.add_timeout(time.time() + WORKER_HANDOFF_WAIT, _expired)
+        _io_loop.add_handler(connection.fileno(), _readable, _io_loop.READ)
+
+    def _on_socket(self, connection, fd):
+        #   The data of the handed over socket follow
+        _relay = IOStream(connection)
+        _relay.read_bytes(WORKER_HANDOFF.size, lambda data: self._on_header(_relay, fd, data))
+        _relay.set_close_callback(lambda: self._on_close(_relay, fd))
+
+    def _on_header(self, relay, fd, data):
+        _family, _size = WORKER_HANDOFF.unpack(data)
+        relay.read_bytes(_size, lambda data: self._on_data(relay, fd, _family, data))
+
+    def _on_data(self, relay, fd, family, data):
+        relay.set_close_callback(None)
+        relay.close()
+        _sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)
+        try:
+            _address = _sock.getpeername()
+        except socket.error:
+            # closed by the peer meanwhile
+            _sock.close()
+            return
+        self._server._handle_connection(_sock, _address, data)
+
+    def _on_close(self, relay, fd):
+        #   The worker handed the socket over has gone before the data are sent
+        gen_log.warning('worker %i: handoff data are lost', worker_id)
+        os.close(fd)
@@ -4,7 +4,10 @@ __author__ = 'morozov'
 import itertools
 from datetime import timedelta
 from collections import deque
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.httputil import HTTPHeaders
+from tornado.iostream import StreamClosedError
+from tornado import stack_context
 import os
 from tornado.options import define, options
 from random import randint
@@ -15,6 +18,7 @@ define('timeout_agent', default=60, type=int)       # Desktop is waiting for App
 define('timeout_cache', default=5, type=int)        # Desktop is considered to be appeared soon
 define('timeout_client', default=5, type=int)       # App is waiting before check whether Desktop is hear
 define('timeout_no_reply', default=15, type=int)    # App is waiting for Desktop reply
+define('channel_ping', default=20, type=int)        # Desktop channel is pinged, the silent one is closed next time
 
 # buffer size: use upper limit Content-Length as a key
 # default 4K for any Content-Length
@@ -30,6 +34,12 @@ MN_RECYCLED = 'X-IWP-IsRecycle'
 MN_NO_AGENT = '0'
 MN_NO_CLIENT = '0'
 MN_NO_REPLY = '1'
+MN_NOT_READY = '2'
+
+# Desktop channel frames (binary WebSocket messages): '<kind> <RequestID>\r\n' + payload
+MN_CHANNEL_HEADERS = 'H'    # header lines of App request / Desktop reply, Content-Length is the data size
+MN_CHANNEL_DATA = 'D'       # next part of the request / reply data
+MN_CHANNEL_CANCEL = 'E'     # reason: the other side gives the interaction up
 
 MN_AGENT_TIMEOUT = MN_AGENT_CACHE_TIMEOUT = MN_CLIENT_TIMEOUT = MN_NO_REPLY_TIMEOUT = None
 
@@ -45,6 +55,7 @@ interactions = {}
 awaiting = {}
 awaiting_cache = {}
 clients = {}
+channels = {}
 request_enum = itertools.count()
 _set_timeout_options()
 options.add_parse_callback(_set_timeout_options)
@@ -76,6 +87,9 @@ class Interaction:
         self._buffer_size = buffer_size
         if not self._buffer_size:
             self._get_buffer_size()
+        if hasattr(self._stream, 'borrow'):
+            # the source is read ahead with a bigger buffer while the data are transferred
+            self._stream.borrow(self._remaining)
 
         self._destination = destination
 
@@ -84,6 +98,10 @@ class Interaction:
                           self._content_length, self._buffer_size))
         self._copy_headers()
         if not self._destination._check_closed():
+            # headers are sent together with the first chunk
+            _destination_stream = self._destination.request.connection.stream
+            if hasattr(_destination_stream, 'cork'):
+                _destination_stream.cork()
             self._destination.flush(callback = self._read_chunk)
 
     def _read_chunk(self):
@@ -91,29 +109,49 @@ class Interaction:
             self._buffer_size = self._remaining
         access_log.debug('[%s]: _read_chunk %s (%i/%i)..' %
                          (self.RequestID, self._source.request.uri, self._buffer_size, self._remaining))
-        self._stream.read_bytes(self._buffer_size,  self._data_callback)
+        if hasattr(self._stream, 'read_view'):
+            # IOStream_mn gives the chunk as memoryview of its buffer: no copy
+            self._stream.read_view(self._buffer_size, self._data_callback,
+                                   self._destination.request.connection.stream)
+        else:
+            self._stream.read_bytes(self._buffer_size, self._data_callback)
 
     def _data_callback(self, data=None):
         self._remaining -= len(data)
         if options.stats_enabled:
             stats_mon._bytes(len(data))
+        _source_finish = False
         if self._remaining > 0:
             _callback = self._read_chunk
         else:
             _callback = self._destination.finish
             if self._source_finish:
                 self._completed = True
-                IOLoop.instance().add_callback(self._source.finish)
+                _source_finish = True
             else:
                 self._source._timeout = IOLoop.instance().add_timeout(
                     MN_NO_REPLY_TIMEOUT, self._source._response_no_reply)
+        _when_sent = IOLoop.instance().add_callback
         if not self._destination._check_closed():
             access_log.debug('[%s]: _data_callback %s (%i/%i)..' %
                              (self.RequestID, self._destination.request.uri, len(data), self._remaining))
-            self._destination.request.write(data, callback = _callback)
+            # HTTPConnection_mn takes memoryview chunks (HTTPRequest.write asserts str)
+            self._destination.request.connection.write(data, callback = _callback)
+            # the last chunk may be a view of the source buffer: the source (its next request
+            # on the keep-alive connection) is finished when it's sent
+            _when_sent = getattr(self._destination.request.connection.stream, 'on_drained', _when_sent)
+        if _source_finish:
+            _when_sent(self._source.finish)
 
     def _copy_headers(self):
-        self._destination._headers = self._source.request.headers
+        _headers = self._source.request.headers
+        if 'Connection' in _headers:
+            # hop-by-hop headers of the source connection are not passed on
+            _headers = HTTPHeaders(_headers)
+            for _name in ('Connection', 'Keep-Alive'):
+                if _name in _headers:
+                    del _headers[_name]
+        self._destination._headers = _headers
         if not MN_REQUEST_ID in self._destination._headers:
             self._destination.set_header(MN_REQUEST_ID, self.RequestID)
         if MN_RESPONSE_CODE in self._destination._headers:
@@ -258,6 +296,167 @@ class _cache:
             pass
 
 
+class ChannelRequest:
+    #   App request pushed to the Desktop over its channel: takes place of the long-polling Desktop
+    #   (destination of App -> Desktop interaction), the headers and the data go as channel frames.
+    #   It's the handler, the request and the connection of the interaction in one.
+    #   The Desktop replies by RequestID over the channel or by /agentreply/.
+    stream = None   # no cork(): frames of other interactions go in between
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.ProductID = channel.ProductID
+        self.RequestID = None
+        self.request = self.connection = self
+        self.uri = channel.request.uri
+        self.no_keep_alive = False
+        self._headers = None
+        self._timeout = None
+        self._length = self._sent = 0
+        if options.stats_enabled:
+            stats_mon._count('Channel_Requests')
+
+    def set_header(self, name, value):
+        self._headers[name] = str(value)
+
+    def set_status(self, status_code):
+        pass
+
+    def flush(self, callback=None):
+        self._length = int(self._headers.get('Content-Length', 0))
+        self.channel.send(channel_frame(MN_CHANNEL_HEADERS, self.RequestID,
+                                        ''.join('%s: %s\r\n' % _h for _h in self._headers.get_all())), callback)
+
+    def write(self, data, callback=None):
+        if not len(data):
+            # no data frame for the empty request
+            if callback:
+                IOLoop.instance().add_callback(callback)
+            return
+        self._sent += len(data)
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.channel.send(channel_frame(MN_CHANNEL_DATA, self.RequestID, data), callback)
+
+    def finish(self):
+        if self._sent < self._length:
+            # App is gone before its data are pushed
+            self.send_error(503)
+        _interaction = get_Interaction(self.RequestID)
+        if _interaction:
+            _interaction._clear_transaction()
+
+    def send_error(self, status_code=500, **kwargs):
+        #   The Desktop is told to drop the request
+        if not self._closed():
+            _reason = str(kwargs['exc_info'][1]) if 'exc_info' in kwargs else ''
+            self.channel.send(channel_frame(MN_CHANNEL_CANCEL, self.RequestID, '%i %s' % (status_code, _reason)))
+
+    def _closed(self):
+        return self.channel.ws_connection is None or self.channel.stream.closed()
+
+    def _check_closed(self):
+        if self.channel.ws_connection is None:
+            raise StreamClosedError()
+        return self.channel.stream._check_closed()
+
+
+class ChannelReply:
+    #   Desktop reply coming over the channel: source of Desktop -> App interaction,
+    #   its data frames are read as a stream (read_bytes() gives the received data up to num_bytes).
+    #   It's the handler, the request, the connection and the stream of the interaction in one.
+    def __init__(self, channel, RequestID, headers):
+        self.channel = channel
+        self.ProductID = channel.ProductID
+        self.RequestID = RequestID
+        self.request = self.connection = self.stream = self
+        self.uri = channel.request.uri
+        self.headers = headers
+        self._timeout = None
+        self._chunks = deque()
+        self._num_bytes = 0
+        self._callback = None
+
+    def feed(self, data):
+        #   Data frame of the reply
+        if len(data):
+            self._chunks.append(data)
+            self._deliver()
+
+    def read_bytes(self, num_bytes, callback):
+        self._num_bytes = num_bytes
+        self._callback = stack_context.wrap(callback)
+        self._deliver()
+
+    def _deliver(self):
+        if self._callback is None or (self._num_bytes and not self._chunks):
+            return
+        _data = b''
+        if self._num_bytes:
+            _data = self._chunks.popleft()
+            if len(_data) > self._num_bytes:
+                self._chunks.appendleft(_data[self._num_bytes:])
+                _data = _data[:self._num_bytes]
+        _callback, self._callback = self._callback, None
+        IOLoop.instance().add_callback(_callback, _data)
+
+    def finish(self):
+        self.channel.replies.pop(self.RequestID, None)
+
+    def _handle_exception(self, typ, value, tb):
+        #   Something goes wrong while the reply is transferred: App gets the error
+        #   (its response is closed if it's started already), the Desktop is told to drop the reply
+        self.finish()
+        _interaction = get_Interaction(self.RequestID)
+        if _interaction and _interaction.client and not _interaction.client._finished:
+            _interaction._completed = False
+            if isinstance(value, IOError):
+                _interaction.client.send_error(503, exc_info=(typ, value, tb))
+            else:
+                app_log.error('[%s]: channel reply of %s failed', self.RequestID, self.ProductID,
+                              exc_info=(typ, value, tb))
+                _interaction.client.send_error(500, exc_info=(typ, value, tb))
+        self.channel.cancel(self.RequestID, 503, value)
+        return True
+
+
+def channel_frame(kind, RequestID, payload=''):
+    return '%s %s\r\n%s' % (kind, RequestID, payload)
+
+def parse_frame(message):
+    #   (kind, RequestID, payload) of the channel frame, payload is memoryview of the message
+    _end = message.find('\r\n')
+    if _end < 0:
+        raise ValueError('No frame line')
+    _kind, _sep, _RequestID = message[:_end].partition(' ')
+    return _kind, _RequestID, memoryview(message)[_end + 2:]
+
+_channel_pings = None
+
+def add_channel(channel):
+    global _channel_pings
+    add_registry('channels', channel)
+    if _channel_pings is None and options.channel_ping:
+        _channel_pings = PeriodicCallback(_ping_channels, options.channel_ping * 1000)
+        _channel_pings.start()
+
+def remove_channel(channel):
+    rem_registry('channels', channel, callback = add_cache)
+
+def get_Channel(ProductID):
+    #   Request of the Desktop channel (the latest one): the channel isn't taken, it serves many requests
+    if ProductID in channels:
+        return ChannelRequest(channels[ProductID][-1])
+    return None
+
+def _ping_channels():
+    for _channels in channels.values():
+        for _channel in list(_channels):
+            _channel.keep_alive()
+
+stats_mon.add_gauge('Channels', lambda: sum(len(_channels) for _channels in channels.values()))
+
+
 def get_cache(ProductID):
     return ProductID in awaiting_cache
 
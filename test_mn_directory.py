@@ -0,0 +1,70 @@
+""" Shared directory checks: python -m unittest test_mn_directory
+"""
+import os
+import new
+import shutil
+import tempfile
+import unittest
+from tornado.options import options
+import mn_directory
+import mn_instance
+
+
+class _SharedTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._shm = mn_directory.SharedDirectory(os.path.join(self._dir, 'directory.shm'), 64)
+
+    def tearDown(self):
+        self._shm.close()
+        shutil.rmtree(self._dir)
+
+
+class SharedDirectoryTest(_SharedTest):
+    def test_long_server_name(self):
+        _server = 'h' * (mn_directory.SHM_SERVER.size + 1)
+        self.assertFalse(self._shm.fits(_server))
+        self.assertRaises(ValueError, self._shm.set, '5', (_server, '8081'))
+        self.assertEqual(self._shm.get('5'), None)
+
+    def test_discard(self):
+        self._shm.set('5', ('myhost', '8081'))
+        self._shm.discard('5')
+        self.assertEqual(self._shm.get('5'), None)
+        self.assertEqual(list(self._shm.items()), [])
+        self._shm.set('5', ('myhost', '8082'))
+        self.assertEqual(self._shm.get('5'), ('myhost', '8082'))
+
+    def test_stale_slot(self):
+        self._shm.set('5', ('myhost', '8081'))
+        _key = self._shm.key('5')
+        _offset = self._shm._offset(self._shm._choose(_key)[0])
+        # the writer crashed between the sequence number updates
+        _seq = mn_directory.SHM_SEQ.unpack_from(self._shm._mm, _offset)[0]
+        mn_directory.SHM_SEQ.pack_into(self._shm._mm, _offset, _seq + 1)
+        self.assertEqual(self._shm.get('5'), None)
+        self._shm.set('5', ('myhost', '8082'))
+        self.assertEqual(self._shm.get('5'), ('myhost', '8082'))
+
+
+class LongServerLocationTest(_SharedTest):
+    #   Locations of the server the shared directory can't keep stay in the instance memory
+    def setUp(self):
+        _SharedTest.setUp(self)
+        self._inst = new.instance(mn_instance.mn_instance, {
+            'server': 'myhost', 'port': '8081', '_shm': self._shm, '_log': None, '_digests': {},
+            '_unshared': set(), '_IDs': mn_directory.location_directory(),
+            '_misses': mn_directory.MissCache(options.timeout_miss)})
+
+    def test_long_server_location(self):
+        _location = ('h' * (mn_directory.SHM_SERVER.size + 1), '9001')
+        self._inst._updateLocation('5', ('otherhost', '9001'))
+        self.assertFalse(self._inst._updateLocation('5', _location))
+        self.assertEqual(self._inst._getLocation('5'), _location)
+        self.assertEqual(self._shm.get('5'), None)
+        self._inst._updateLocation('5', ('otherhost', '9002'))
+        self.assertEqual(self._inst._getLocation('5'), ('otherhost', '9002'))
+
+
+if __name__ == '__main__':
+    unittest.main()